@@ -0,0 +1,285 @@
+"""Delete deactivated accounts in the background, a batch at a time.
+
+`/users/delete` only marks the account deactivated, which hides it
+everywhere, and queues it here. A background thread, started by the
+first account queued in each process, then deletes the
+user's likes, follows, home timeline and messages (with the timeline
+entries and likes they have elsewhere) ACCOUNT_PURGE_BATCH_SIZE rows at a
+time, each batch in its own short transaction, and finally the user row.
+Every batch also takes its rows out of the other users' and messages'
+denormalized counters, so they stay right while a large account is
+being purged.
+
+A purge can stop anywhere and pick up where it left off. `flask
+purge-accounts` purges every deactivated account, e.g. after a restart,
+or on a schedule when ACCOUNT_PURGE_IN_BACKGROUND is off.
+"""
+
+import logging
+import os
+import queue
+import threading
+from collections import Counter, defaultdict
+
+from flask import current_app
+from sqlalchemy import delete, select, tuple_
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+logger = logging.getLogger(__name__)
+
+
+def _unlike_batch(user_id, batch_size):
+    """Delete a batch of the user's likes."""
+
+    message_ids = db.session.scalars(
+        delete(Likes)
+        .where(Likes.user_id == user_id)
+        .where(Likes.message_id.in_(
+            select(Likes.message_id)
+            .where(Likes.user_id == user_id)
+            .limit(batch_size)))
+        .returning(Likes.message_id),
+        execution_options={'synchronize_session': False}).all()
+
+    if message_ids:
+        Message.adjust_like_count(message_ids, -1)
+    return len(message_ids)
+
+
+def _unfollow_batch(user_id, batch_size):
+    """Delete a batch of the follows the user made.
+
+    Authors this takes back down to the fan-out limit get their recent
+    messages fanned out again, as `User.stop_following` does.
+    """
+
+    followed_ids = db.session.scalars(
+        delete(Follows)
+        .where(Follows.user_following_id == user_id)
+        .where(Follows.user_being_followed_id.in_(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id)
+            .limit(batch_size)))
+        .returning(Follows.user_being_followed_id),
+        execution_options={'synchronize_session': False}).all()
+
+    if followed_ids:
+        User.adjust_counter(followed_ids, 'followers_count', -1)
+        TimelineEntry.catch_up(followed_ids,
+                               current_app.config['TIMELINE_FANOUT_LIMIT'],
+                               current_app.config['TIMELINE_BACKFILL_SIZE'])
+    return len(followed_ids)
+
+
+def _remove_followers_batch(user_id, batch_size):
+    """Delete a batch of the follows of the user."""
+
+    follower_ids = db.session.scalars(
+        delete(Follows)
+        .where(Follows.user_being_followed_id == user_id)
+        .where(Follows.user_following_id.in_(
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id)
+            .limit(batch_size)))
+        .returning(Follows.user_following_id),
+        execution_options={'synchronize_session': False}).all()
+
+    if follower_ids:
+        User.adjust_counter(follower_ids, 'following_count', -1)
+    return len(follower_ids)
+
+
+def _delete_rows(model, condition, batch_size):
+    """Delete up to `batch_size` rows of `model` matching `condition`."""
+
+    key = model.__table__.primary_key.columns
+    result = db.session.execute(
+        delete(model)
+        .where(tuple_(*key).in_(select(*key).where(condition)
+                                .limit(batch_size))),
+        execution_options={'synchronize_session': False})
+    return result.rowcount
+
+
+def _clear_timeline_batch(user_id, batch_size):
+    """Delete a batch of the user's home timeline."""
+
+    return _delete_rows(TimelineEntry, TimelineEntry.user_id == user_id,
+                        batch_size)
+
+
+def _delete_messages_batch(user_id, batch_size):
+    """Delete a batch of the user's messages.
+
+    A message can be in thousands of timelines and liked thousands of
+    times, so those rows go first, `batch_size` per transaction; the users
+    who liked it lose the like from likes_count. Only the search postings
+    are left to cascade with the messages.
+    """
+
+    message_ids = db.session.scalars(
+        select(Message.id)
+        .where(Message.user_id == user_id)
+        .limit(batch_size)).all()
+
+    if not message_ids:
+        return 0
+
+    while _delete_rows(TimelineEntry, TimelineEntry.message_id.in_(message_ids),
+                       batch_size) == batch_size:
+        db.session.commit()
+
+    while True:
+        liker_ids = db.session.scalars(
+            delete(Likes)
+            .where(tuple_(Likes.user_id, Likes.message_id).in_(
+                select(Likes.user_id, Likes.message_id)
+                .where(Likes.message_id.in_(message_ids))
+                .limit(batch_size)))
+            .returning(Likes.user_id),
+            execution_options={'synchronize_session': False}).all()
+
+        # one UPDATE per distinct number of likes, not per liker
+        likers_by_count = defaultdict(list)
+        for liker_id, count in Counter(liker_ids).items():
+            likers_by_count[count].append(liker_id)
+        for count, ids in likers_by_count.items():
+            User.adjust_counter(ids, 'likes_count', -count)
+
+        if len(liker_ids) < batch_size:
+            break
+        db.session.commit()
+
+    db.session.execute(
+        delete(Message).where(Message.id.in_(message_ids)),
+        execution_options={'synchronize_session': False})
+    return len(message_ids)
+
+
+STEPS = (_unlike_batch, _unfollow_batch, _remove_followers_batch,
+         _clear_timeline_batch, _delete_messages_batch)
+
+
+def purge_account(user_id, batch_size=1000):
+    """Delete a deactivated user and everything they own, batch by batch.
+
+    Commits after every batch. Does nothing unless the account is
+    deactivated. Returns the number of rows deleted, not counting
+    cascades.
+    """
+
+    deactivated = db.session.scalar(
+        select(User.deactivated_at).where(User.id == user_id))
+    if deactivated is None:
+        return 0
+
+    deleted = 0
+    for step in STEPS:
+        while True:
+            removed = step(user_id, batch_size)
+            db.session.commit()
+            deleted += removed
+            if removed < batch_size:
+                break
+
+    db.session.execute(
+        delete(User)
+        .where(User.id == user_id)
+        .where(User.deactivated_at.isnot(None)),
+        execution_options={'synchronize_session': False})
+    db.session.commit()
+
+    return deleted + 1
+
+
+def purge_deactivated(batch_size=1000):
+    """Purge every deactivated account. Returns how many were purged."""
+
+    user_ids = db.session.scalars(
+        select(User.id).where(User.deactivated_at.isnot(None))).all()
+
+    for user_id in user_ids:
+        purge_account(user_id, batch_size)
+
+    return len(user_ids)
+
+
+class AccountPurger:
+    """Purge queued accounts one at a time on a background thread."""
+
+    def __init__(self, app, batch_size=1000):
+        self.app = app
+        self.batch_size = batch_size
+        # a forked child inherits this object but not its thread
+        self.pid = os.getpid()
+
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._work, daemon=True,
+                                        name='account-purge')
+        self._worker.start()
+
+    def enqueue(self, user_id):
+        self._queue.put(user_id)
+
+    def _work(self):
+        while True:
+            user_id = self._queue.get()
+            try:
+                if user_id is None:
+                    return
+                with self.app.app_context():
+                    purge_account(user_id, self.batch_size)
+            except Exception:
+                logger.exception("Couldn't purge account %s", user_id)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until every account queued so far is purged."""
+
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+
+purger = None
+_purger_lock = threading.Lock()
+
+
+def running(app):
+    """This process's purger, started now if it isn't running yet."""
+
+    global purger
+
+    with _purger_lock:
+        if purger is None or purger.pid != os.getpid():
+            purger = AccountPurger(app, app.config['ACCOUNT_PURGE_BATCH_SIZE'])
+        return purger
+
+
+def enqueue(user_id):
+    """Queue a deactivated account for purging in the background.
+
+    The purger thread starts with the first account queued in each
+    process, so importing the app (CLI commands, seed.py, a pre-forking
+    server's parent) doesn't start one. With ACCOUNT_PURGE_IN_BACKGROUND
+    off, the account waits for `flask purge-accounts`.
+    """
+
+    app = current_app._get_current_object()
+    if app.config['ACCOUNT_PURGE_IN_BACKGROUND']:
+        running(app).enqueue(user_id)
+
+
+def stop():
+    """Stop the purger, after it finishes the accounts already queued."""
+
+    global purger
+
+    with _purger_lock:
+        current, purger = purger, None
+    if current is not None and current.pid == os.getpid():
+        current.close()
@@ -0,0 +1,400 @@
+"""Versioned JSON API: /api/v1/.
+
+Mirrors the HTML pages for clients that only need the data:
+
+- GET /api/v1/timeline: the logged-in user's home feed
+- GET /api/v1/users/<id>: a profile
+- GET /api/v1/users/<id>/messages: a user's messages
+- GET /api/v1/users/<id>/followers and /following
+- GET /api/v1/users/<id>/likes: messages a user liked
+- GET /api/v1/messages/<id>: one message
+- POST / DELETE /api/v1/messages/<id>/like: like / unlike a message
+- POST / DELETE /api/v1/users/<id>/follow: follow / unfollow a user
+
+Authentication is the same session cookie the site uses, and the same
+pages require it. Likes and follows answer with the new state and the
+counts it changed, so pages can update in place; see static/js/toggles.js. Queries select only the columns a response needs and
+serialize the rows directly, without building ORM objects; `?fields=`
+narrows a response to a comma-separated subset of fields. Responses are
+encoded with orjson when it's installed.
+
+Message lists are paged newest first like the HTML timelines, with
+`older` / `newer` links. User lists are paged by user id with a `next`
+link. `?limit=` sets the page size, up to API_MAX_PAGE_SIZE.
+"""
+
+import json
+
+from flask import Blueprint, abort, current_app, g, request, url_for
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException
+
+import current_user
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from pagination import apply_cursor, cursor_args, id_cursor_arg, make_page
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'like_count': Message.like_count,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'user_image_url': User.image_url.label('user_image_url'),
+}
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'followers_count': User.followers_count,
+    'following_count': User.following_count,
+    'likes_count': User.likes_count,
+}
+
+# whether the viewer liked a message; looked up once per page, not selected
+LIKED_FIELD = 'liked'
+
+DEFAULT_MESSAGE_FIELDS = tuple(MESSAGE_FIELDS) + (LIKED_FIELD,)
+DEFAULT_USER_LIST_FIELDS = ('id', 'username', 'image_url', 'bio')
+
+
+##############################################################################
+# Serialization
+
+
+def _default(value):
+    return value.isoformat()
+
+
+def dumps(payload):
+    """Encode `payload` as JSON bytes, with orjson when it's available."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=_default,
+                      separators=(',', ':')).encode()
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(dumps(payload), status=status,
+                                      mimetype='application/json')
+
+
+@api.errorhandler(HTTPException)
+def http_error(error):
+    """Errors from API views are JSON too."""
+
+    return json_response({'error': error.description}, error.code)
+
+
+##############################################################################
+# Helpers
+
+
+def requested_fields(available, default):
+    """Field names from `?fields=`, or `default`. Aborts 400 on unknown names."""
+
+    fields = request.args.get('fields')
+    if fields is None:
+        return default
+
+    names = tuple(dict.fromkeys(
+        name.strip() for name in fields.split(',') if name.strip()))
+    unknown = [name for name in names if name not in available]
+
+    if unknown or not names:
+        abort(400, f"Unknown fields: {', '.join(unknown) or '(none)'}. "
+                   f"Choose from: {', '.join(available)}.")
+
+    return names
+
+
+def page_limit():
+    """Page size from `?limit=`. Aborts 400 if it's out of range."""
+
+    maximum = current_app.config['API_MAX_PAGE_SIZE']
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'],
+                             type=int)
+
+    if not 1 <= limit <= maximum:
+        abort(400, f"limit must be between 1 and {maximum}.")
+
+    return limit
+
+
+def require_login():
+    if not g.user:
+        abort(401, "Log in to see this.")
+
+
+def require_user(user_id):
+    if db.session.scalar(select(User.id)
+                         .where(User.id == user_id)
+                         .where(User.deactivated_at.is_(None))) is None:
+        abort(404, "No such user.")
+
+
+def page_url(**cursor):
+    """This endpoint's URL with the current query string and a new cursor."""
+
+    # query args named like a view arg or url_for's own `_external` etc.
+    # would clash with them, so they're dropped
+    args = {key: value for key, value in request.args.items()
+            if key not in ('before', 'after')
+            and key not in request.view_args
+            and not key.startswith('_')}
+    args.update(cursor)
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+def columns_for(fields, available, required):
+    """Columns to select for `fields`, plus the `required` ones."""
+
+    names = dict.fromkeys(required + tuple(
+        name for name in fields if name in available))
+    return [available[name] for name in names]
+
+
+def message_dicts(rows, fields):
+    liked_ids = set()
+    if LIKED_FIELD in fields and g.user:
+        liked_ids = Likes.liked_message_ids(g.user.id,
+                                            [row.id for row in rows])
+
+    selected = [field for field in fields if field != LIKED_FIELD]
+    items = []
+
+    for row in rows:
+        mapping = row._mapping
+        item = {field: mapping[field] for field in selected}
+        if LIKED_FIELD in fields:
+            item[LIKED_FIELD] = row.id in liked_ids if g.user else None
+        items.append(item)
+
+    return items
+
+
+def message_columns(fields):
+    # pages are keyed on (timestamp, id), so those are always selected
+    return columns_for(fields, MESSAGE_FIELDS, ('id', 'timestamp'))
+
+
+def message_page_response(page, fields):
+    return json_response({
+        'data': message_dicts(page.items, fields),
+        'older': page_url(before=page.older) if page.older else None,
+        'newer': page_url(after=page.newer) if page.newer else None,
+    })
+
+
+def message_list(query, fields):
+    """Respond with one newest-first page of `query`'s message rows."""
+
+    before, after = cursor_args()
+    limit = page_limit()
+
+    rows = apply_cursor(query, Message.timestamp, Message.id,
+                        limit, before, after).all()
+    page = make_page(rows, lambda row: (row.timestamp, row.id),
+                     limit, before, after)
+
+    return message_page_response(page, fields)
+
+
+def user_list(user_id, user_column, other_column):
+    """Respond with one page of the users on the other side of `follows`."""
+
+    require_login()
+    require_user(user_id)
+    fields = requested_fields(USER_FIELDS, DEFAULT_USER_LIST_FIELDS)
+    limit = page_limit()
+    after = id_cursor_arg()
+
+    query = (select(*columns_for(fields, USER_FIELDS, ('id',)))
+             .join(Follows, other_column == User.id)
+             .where(user_column == user_id)
+             .where(User.deactivated_at.is_(None)))
+    if after is not None:
+        query = query.where(other_column > after)
+
+    rows = db.session.execute(
+        query.order_by(other_column).limit(limit + 1)).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return json_response({
+        'data': [{field: row._mapping[field] for field in fields}
+                 for row in rows],
+        'next': page_url(after=rows[-1].id) if has_more else None,
+    })
+
+
+##############################################################################
+# Routes
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's home feed."""
+
+    require_login()
+    fields = requested_fields(DEFAULT_MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+    before, after = cursor_args()
+
+    page = TimelineEntry.messages_for(
+        g.user.id, current_app.config['TIMELINE_FANOUT_LIMIT'],
+        page_limit(), before, after, columns=message_columns(fields))
+
+    return message_page_response(page, fields)
+
+
+@api.route('/users/<int:user_id>')
+def user_detail(user_id):
+    """A user's profile and counts."""
+
+    fields = requested_fields(USER_FIELDS, tuple(USER_FIELDS))
+    row = db.session.execute(
+        select(*columns_for(fields, USER_FIELDS, ()))
+        .where(User.id == user_id)
+        .where(User.deactivated_at.is_(None))).first()
+
+    if row is None:
+        abort(404, "No such user.")
+
+    return json_response({'data': dict(row._mapping)})
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    require_user(user_id)
+    fields = requested_fields(DEFAULT_MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+
+    return message_list(
+        Message.row_query(message_columns(fields))
+        .filter(Message.user_id == user_id),
+        fields)
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user."""
+
+    return user_list(user_id, Follows.user_being_followed_id,
+                     Follows.user_following_id)
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows."""
+
+    return user_list(user_id, Follows.user_following_id,
+                     Follows.user_being_followed_id)
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages this user liked, newest message first."""
+
+    require_login()
+    require_user(user_id)
+    fields = requested_fields(DEFAULT_MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+
+    return message_list(
+        Message.row_query(message_columns(fields))
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id),
+        fields)
+
+
+@api.route('/messages/<int:message_id>')
+def message_detail(message_id):
+    """One message."""
+
+    fields = requested_fields(DEFAULT_MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+    row = (Message.row_query(message_columns(fields))
+           .filter(Message.id == message_id)
+           .first())
+
+    if row is None:
+        abort(404, "No such message.")
+
+    return json_response({'data': message_dicts([row], fields)[0]})
+
+
+@api.route('/messages/<int:message_id>/like', methods=['POST', 'DELETE'])
+def message_like(message_id):
+    """Like (POST) or unlike (DELETE) a message as the logged-in user."""
+
+    require_login()
+    author_id = db.session.scalar(
+        select(Message.user_id)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id)
+        .where(User.deactivated_at.is_(None)))
+
+    if author_id is None:
+        abort(404, "No such message.")
+    if author_id == g.user.id:
+        abort(403, "You can't like your own message.")
+
+    liked = request.method == 'POST'
+    Likes.set_liked(g.user.id, message_id, liked)
+    db.session.commit()
+    current_user.invalidate(g.user.id)
+
+    return json_response({'data': {
+        'message_id': message_id,
+        'liked': liked,
+        'like_count': db.session.scalar(
+            select(Message.like_count).where(Message.id == message_id)),
+        'user_id': g.user.id,
+        'likes_count': db.session.scalar(
+            select(User.likes_count).where(User.id == g.user.id)),
+    }})
+
+
+@api.route('/users/<int:user_id>/follow', methods=['POST', 'DELETE'])
+def user_follow(user_id):
+    """Follow (POST) or unfollow (DELETE) a user as the logged-in user."""
+
+    require_login()
+    require_user(user_id)
+
+    following = request.method == 'POST'
+    if following and user_id == g.user.id:
+        abort(403, "You can't follow yourself.")
+    if following:
+        User.start_following(g.user.id, user_id,
+                             current_app.config['TIMELINE_FANOUT_LIMIT'],
+                             current_app.config['TIMELINE_BACKFILL_SIZE'])
+    else:
+        User.stop_following(g.user.id, user_id,
+                            current_app.config['TIMELINE_FANOUT_LIMIT'],
+                            current_app.config['TIMELINE_BACKFILL_SIZE'])
+    db.session.commit()
+    current_user.invalidate(g.user.id, user_id)
+
+    return json_response({'data': {
+        'user_id': user_id,
+        'following': following,
+        'followers_count': db.session.scalar(
+            select(User.followers_count).where(User.id == user_id)),
+        'follower_id': g.user.id,
+        'following_count': db.session.scalar(
+            select(User.following_count).where(User.id == g.user.id)),
+    }})
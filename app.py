@@ -1,11 +1,28 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+import click
+from flask import Flask, render_template, stream_template, request, flash, redirect, session, g, url_for, abort, Response
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 
+import account_purge
+import current_user
+import metrics
+import migrations
+import slow_queries
+from api import api
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from hashing import HashingPoolBusy
+from http_cache import (apply_cache_policy, cache_policy, conditional_response,
+                        deployed_at, static_url)
+from models import db, connect_db, User, Message, Follows, Likes, TimelineEntry
+from pagination import (IdPage, apply_cursor, apply_id_cursor, cursor_args,
+                        id_cursor_arg, make_page)
+from read_models import (TIMELINE_ITEM_COLUMNS, TimelineItem, UserCard,
+                         timeline_page)
+from search import (create_user_search_index, search_users, search_messages,
+                    index_message, unindex_message, rebuild_message_index)
 
 CURR_USER_KEY = "curr_user"
 
@@ -21,10 +38,82 @@ app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Seconds a logged-in user's snapshot is served from cache; 0 disables it.
+app.config['CURRENT_USER_CACHE_TTL'] = int(
+    os.environ.get('CURRENT_USER_CACHE_TTL', 30))
+# Password hashing runs on a bounded pool; see hashing.py.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_EXECUTOR'] = os.environ.get(
+    'PASSWORD_HASH_EXECUTOR', 'thread')
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 0)) or None
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 0)) or None
+app.config['PASSWORD_HASH_WAIT'] = float(
+    os.environ.get('PASSWORD_HASH_WAIT', 2))
+# Per-endpoint Cache-Control overrides, e.g. {'messages_show': 'public, max-age=60'}.
+app.config['CACHE_POLICIES'] = {}
+# Release id (e.g. a git sha) mixed into ETags so a deploy invalidates cached
+# pages; unset = the newest mtime of the code, templates and static files.
+app.config['RELEASE_VERSION'] = os.environ.get('RELEASE_VERSION')
+
+# Authors with more followers than this are not fanned out on write; their
+# messages are merged into followers' home timelines at read time instead.
+app.config['TIMELINE_FANOUT_LIMIT'] = int(
+    os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+# How many of an author's recent messages to copy in on a new follow.
+app.config['TIMELINE_BACKFILL_SIZE'] = int(
+    os.environ.get('TIMELINE_BACKFILL_SIZE', 100))
+# Messages per page on the home, profile and likes timelines.
+app.config['TIMELINE_PAGE_SIZE'] = int(
+    os.environ.get('TIMELINE_PAGE_SIZE', 100))
+# Rows fetched per round trip when streaming the user listing pages.
+app.config['STREAM_BATCH_SIZE'] = int(
+    os.environ.get('STREAM_BATCH_SIZE', 500))
+# Users per page on the directory, followers and following pages.
+app.config['USER_LIST_PAGE_SIZE'] = int(
+    os.environ.get('USER_LIST_PAGE_SIZE', 60))
+# Most users returned by a /users?q= search.
+app.config['USER_SEARCH_LIMIT'] = int(
+    os.environ.get('USER_SEARCH_LIMIT', 50))
+# Results per page and deepest page for /messages/search.
+app.config['MESSAGE_SEARCH_PAGE_SIZE'] = int(
+    os.environ.get('MESSAGE_SEARCH_PAGE_SIZE', 20))
+app.config['MESSAGE_SEARCH_MAX_PAGE'] = int(
+    os.environ.get('MESSAGE_SEARCH_MAX_PAGE', 50))
+# Log statements slower than this many ms, with EXPLAIN plans; unset = off.
+app.config['SLOW_QUERY_THRESHOLD_MS'] = (
+    float(os.environ['SLOW_QUERY_THRESHOLD_MS'])
+    if os.environ.get('SLOW_QUERY_THRESHOLD_MS') else None)
+app.config['SLOW_QUERY_LOG'] = os.environ.get(
+    'SLOW_QUERY_LOG', 'slow_queries.jsonl')
+app.config['SLOW_QUERY_EXPLAIN'] = (
+    os.environ.get('SLOW_QUERY_EXPLAIN', '1') != '0')
+app.config['SLOW_QUERY_LOG_MAX_BYTES'] = int(
+    os.environ.get('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024))
+app.config['SLOW_QUERY_LOG_BACKUP_COUNT'] = int(
+    os.environ.get('SLOW_QUERY_LOG_BACKUP_COUNT', 5))
+# Default and largest page sizes for /api/v1/ lists.
+app.config['API_PAGE_SIZE'] = int(os.environ.get('API_PAGE_SIZE', 50))
+app.config['API_MAX_PAGE_SIZE'] = int(
+    os.environ.get('API_MAX_PAGE_SIZE', 200))
+# Rows deleted per transaction when purging a deleted account.
+app.config['ACCOUNT_PURGE_BATCH_SIZE'] = int(
+    os.environ.get('ACCOUNT_PURGE_BATCH_SIZE', 1000))
+# Purge deleted accounts on a background thread; off = `flask purge-accounts`.
+app.config['ACCOUNT_PURGE_IN_BACKGROUND'] = (
+    os.environ.get('ACCOUNT_PURGE_IN_BACKGROUND', '1') != '0')
 toolbar = DebugToolbarExtension(app)
+app.add_template_global(static_url)
+app.register_blueprint(api)
 
 connect_db(app)
 
+with app.app_context():
+    metrics.init_app(app, db.engine)
+    slow_queries.init_app(app, db.engine)
+
 
 ##############################################################################
 # User signup/login/logout
@@ -39,8 +128,10 @@ def add_user_to_g():
 
     # g is a special object in Flask used as a "generic data bucket" to share information across multiple requests.
     #This makes it a convenient place to store data that needs to be accessible across multiple parts of the application, but not retained between requests.
+    # g.user is a cached read-only snapshot; views that change the user
+    # use g.user.model to load the full User.
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = current_user.load_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -60,6 +151,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@cache_policy('no-store')
 def signup():
     """Handle user signup.
 
@@ -85,6 +177,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except HashingPoolBusy:
+            flash("Warbler is busy right now, please try again.", 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -94,14 +190,19 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@cache_policy('no-store')
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                    form.password.data)
+        except HashingPoolBusy:
+            flash("Warbler is busy right now, please try again.", 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
             do_login(user)
@@ -124,38 +225,102 @@ def logout():
 ##############################################################################
 # General user routes:
 
+def stream_users(query):
+    """Run a select() of user card columns through a server-side cursor.
+
+    Yields lists of `UserCard`s, STREAM_BATCH_SIZE at a time.
+    """
+
+    result = db.session.execute(query.execution_options(
+        yield_per=app.config['STREAM_BATCH_SIZE']))
+
+    for rows in result.partitions():
+        yield UserCard.from_rows(rows)
+
+
+def with_follow_state(batches):
+    """Yield (user, followed) for each user in `batches` of users.
+
+    `followed` says whether the logged-in user follows them; it's looked
+    up once per batch, so pages can stream without loading every user
+    first.
+    """
+
+    for users in batches:
+        following_ids = (g.user.following_ids_among([user.id for user in users])
+                         if g.user else set())
+        for user in users:
+            yield user, user.id in following_ids
+
+
+def user_list_page(query, id_column):
+    """The `?after=` page of `query`'s users, ordered by `id_column`.
+
+    `id_column` is the user id the list is keyed on. The page streams
+    (user, followed) pairs; see `with_follow_state`.
+    """
+
+    limit = app.config['USER_LIST_PAGE_SIZE']
+    users = stream_users(
+        apply_id_cursor(query, id_column, limit, id_cursor_arg()))
+
+    return IdPage(with_follow_state(users), lambda row: row[0].id, limit)
+
+
 @app.route('/users')
 def list_users():
     """Search page with listing of users.
 
-    Can take a 'q' parameter in querystring to search by that username.
+    Can take a 'q' parameter in querystring to search by that username
+    (or bio / location); results are ranked and limited. Without one the
+    directory is streamed a page at a time.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = user_list_page(UserCard.select(), User.id)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = with_follow_state(
+            [search_users(search, app.config['USER_SEARCH_LIMIT'])])
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', users=users)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Answers 304 when the profile, its newest message and the viewer's
+    follow state are unchanged since the client's copy.
+    """
 
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).one_or_404()
+    latest_id, latest_timestamp = Message.latest_for(user_id)
+    following = (g.user.is_following(user)
+                 if g.user and g.user.id != user.id else None)
+
+    not_modified = conditional_response(
+        user.username, user.image_url, user.header_image_url, user.bio,
+        user.location, user.messages_count, user.followers_count,
+        user.following_count, user.likes_count, latest_id, following,
+        request.query_string, last_modified=latest_timestamp)
+    if not_modified:
+        return not_modified
+
+    before, after = cursor_args()
+    limit = app.config['TIMELINE_PAGE_SIZE']
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages = TimelineItem.from_rows(apply_cursor(
+        TimelineItem.query().filter(Message.user_id == user_id),
+        Message.timestamp, Message.id, limit, before, after))
+    page = make_page(messages, lambda msg: (msg.timestamp, msg.id),
+                     limit, before, after)
+
+    return render_template('users/show.html', user=user, messages=page,
+                           following=following)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -166,8 +331,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.active().filter_by(id=user_id).one_or_404()
+    following = user_list_page(
+        UserCard.select()
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .where(Follows.user_following_id == user_id),
+        Follows.user_being_followed_id)
+
+    return stream_template('users/following.html', user=user, users=following)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -178,8 +349,14 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.active().filter_by(id=user_id).one_or_404()
+    followers = user_list_page(
+        UserCard.select()
+        .join(Follows, Follows.user_following_id == User.id)
+        .where(Follows.user_being_followed_id == user_id),
+        Follows.user_following_id)
+
+    return stream_template('users/followers.html', user=user, users=followers)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -190,9 +367,19 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
+    db.first_or_404(select(User.id)
+                    .where(User.id == follow_id)
+                    .where(User.deactivated_at.is_(None)))
+
+    User.start_following(g.user.id, follow_id,
+                         app.config['TIMELINE_FANOUT_LIMIT'],
+                         app.config['TIMELINE_BACKFILL_SIZE'])
     db.session.commit()
+    current_user.invalidate(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -205,14 +392,19 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    db.first_or_404(select(User.id).where(User.id == follow_id))
+
+    User.stop_following(g.user.id, follow_id,
+                        app.config['TIMELINE_FANOUT_LIMIT'],
+                        app.config['TIMELINE_BACKFILL_SIZE'])
     db.session.commit()
+    current_user.invalidate(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@cache_policy('no-store')
 def profile():
     """Update profile for current user."""
 
@@ -223,10 +415,16 @@ def profile():
     form = UserEditForm()
     
     if form.validate_on_submit():
-        user = g.user
+        user = g.user.model
         
-        if not User.check_password(form.username.data,
-                                form.password.data):
+        try:
+            password_ok = user.verify_password(form.password.data)
+        except HashingPoolBusy:
+            flash("Warbler is busy right now, please try again.", 'danger')
+            return render_template('users/edit.html', form=form,
+                                   user_id=g.user.id), 503
+
+        if not password_ok:
             flash("Incorrect Password Entered.", "danger")
             return redirect(url_for('homepage'))
             
@@ -237,6 +435,7 @@ def profile():
         user.bio = form.bio.data
         
         db.session.commit()
+        current_user.invalidate(user.id)
         return redirect(url_for('users_show', user_id=user.id))
 
     return render_template('users/edit.html', form=form, user_id=g.user.id)    
@@ -244,7 +443,11 @@ def profile():
 
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account is only deactivated here, which hides it right away; its
+    rows are deleted in the background by account_purge.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -252,8 +455,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    User.deactivate(g.user.id)
     db.session.commit()
+    current_user.invalidate(g.user.id)
+    account_purge.enqueue(g.user.id)
 
     return redirect("/signup")
 
@@ -266,16 +471,17 @@ def register_user_likes(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    user = g.user
-    message = Message.query.get_or_404(message_id)
+    author_id = db.first_or_404(
+        select(Message.user_id)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id)
+        .where(User.deactivated_at.is_(None)))
     
-    if message.user_id != user.id:
-        if message in user.likes:
-            user.likes.remove(message)
-        else:          
-            user.likes.append(message)
-        
+    if author_id != g.user.id:
+        if not Likes.set_liked(g.user.id, message_id, False):
+            Likes.set_liked(g.user.id, message_id, True)
         db.session.commit()    
+        current_user.invalidate(g.user.id)
         
     return redirect(url_for('homepage'))
 
@@ -288,15 +494,27 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    
-    return render_template('users/likes.html', user=user)
+    user = User.active().filter_by(id=user_id).one_or_404()
+    before, after = cursor_args()
+    limit = app.config['TIMELINE_PAGE_SIZE']
+
+    liked = (TimelineItem
+             .query()
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id))
+    messages = TimelineItem.from_rows(apply_cursor(
+        liked, Message.timestamp, Message.id, limit, before, after))
+    page = make_page(messages, lambda msg: (msg.timestamp, msg.id),
+                     limit, before, after)
+
+    return stream_template('users/likes.html', user=user, messages=page)
 
 
 ##############################################################################
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@cache_policy('no-store')
 def messages_add():
     """Add a message:
     Show form if GET. If valid, update message and redirect to user page.
@@ -309,20 +527,60 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counter(g.user.id, 'messages_count', 1)
+        TimelineEntry.fan_out(msg, app.config['TIMELINE_FANOUT_LIMIT'])
+        index_message(msg)
         db.session.commit()
+        current_user.invalidate(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search warbles by text.
+
+    Takes a 'q' parameter in querystring and an optional 'page' number.
+    """
+
+    search = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+
+    if page < 1 or page > app.config['MESSAGE_SEARCH_MAX_PAGE']:
+        abort(400)
+
+    messages, has_next = search_messages(
+        search, page, app.config['MESSAGE_SEARCH_PAGE_SIZE'])
+
+    return render_template('messages/search.html', messages=messages,
+                           search=search, page=page, has_next=has_next)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = (Message
+           .timeline_query()
+           .filter(Message.id == message_id)
+           .first_or_404())
+    if msg.user.deactivated_at is not None:
+        abort(404)
+
+    following = (g.user.is_following(msg.user)
+                 if g.user and g.user.id != msg.user_id else None)
+
+    not_modified = conditional_response(
+        msg.id, msg.text, msg.timestamp, msg.user.username,
+        msg.user.image_url, following, last_modified=msg.timestamp)
+    if not_modified:
+        return not_modified
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -335,8 +593,14 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
+    # timeline rows also cascade in the database; delete them explicitly so
+    # the session doesn't hold stale entries
+    TimelineEntry.query.filter_by(message_id=msg.id).delete()
+    unindex_message(msg)
+    User.uncount_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    current_user.invalidate(msg.user_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -350,43 +614,131 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, read from the
+      precomputed home timeline one page at a time
     """
 
     if g.user:
-        user = g.user
-
-        #list of users current user is following.
-        #can access message id, username, emai, messages, etc..        
-        user_following = user.following
-        user_following_ids = [user.id for user in user_following]
-        
-        messages = (Message
-                    .query
-                    .filter((Message.user_id.in_(user_following_ids)) | (Message.user_id == user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        before, after = cursor_args()
+        messages = timeline_page(TimelineEntry.messages_for(
+            g.user.id, app.config['TIMELINE_FANOUT_LIMIT'],
+            app.config['TIMELINE_PAGE_SIZE'], before, after,
+            columns=TIMELINE_ITEM_COLUMNS))
+        liked_ids = Likes.liked_message_ids(g.user.id,
+                                            [msg.id for msg in messages])
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html', messages=messages,
+                               liked_ids=liked_ids)
 
     else:
+        not_modified = conditional_response('home-anon',
+                                            last_modified=deployed_at())
+        if not_modified:
+            return not_modified
+
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Maintenance commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every home timeline from messages and follows."""
+
+    TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_LIMIT'],
+                          app.config['TIMELINE_BACKFILL_SIZE'])
+    db.session.commit()
+    print("Rebuilt home timelines.")
+
+
+@app.cli.command('create-search-indexes')
+def create_search_indexes():
+    """Add the user search index to an existing database."""
+
+    with db.engine.begin() as connection:
+        create_user_search_index(connection)
+    print("Created search indexes.")
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Rebuild the message search index from messages."""
+
+    rebuild_message_index()
+    db.session.commit()
+    print("Rebuilt message search index.")
+
+
+@app.cli.command('migrate')
+def migrate():
+    """Bring an existing database up to date with models.py."""
+
+    migrations.run(db.engine)
+    print("Database is up to date.")
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute the denormalized counters on users and messages."""
+
+    User.repair_counters()
+    Message.repair_like_counts()
+    db.session.commit()
+    print("Repaired user counters and message like counts.")
+
+
+@app.cli.command('purge-accounts')
+def purge_accounts():
+    """Delete every deactivated account and everything it owns."""
+
+    purged = account_purge.purge_deactivated(
+        app.config['ACCOUNT_PURGE_BATCH_SIZE'])
+    print(f"Purged {purged} deactivated accounts.")
+
+
+@app.cli.command('slow-queries')
+@click.option('--log', 'log_path', default=None,
+              help='Slow query log to read (default: SLOW_QUERY_LOG).')
+@click.option('--top', default=10, help='How many statements to show.')
+def summarize_slow_queries(log_path, top):
+    """Show the statements with the most total time in the slow query log."""
+
+    offenders = slow_queries.summarize(log_path or app.config['SLOW_QUERY_LOG'],
+                                       top)
+
+    for rank, stats in enumerate(offenders, 1):
+        print(f"{rank}. {stats['total_ms']:.1f} ms total, {stats['count']} "
+              f"calls, {stats['mean_ms']:.1f} ms mean, "
+              f"{stats['max_ms']:.1f} ms max "
+              f"[{', '.join(stats['endpoints']) or 'no route'}]")
+        print(f"   {' '.join(stats['statement'].split())}")
+
+
+##############################################################################
+# Metrics
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Query counts, DB time, request latency and template render time per
+# endpoint, in Prometheus text format. See metrics.py.
+
+@app.route('/metrics')
+@cache_policy('no-store')
+def show_metrics():
+    """Expose request metrics for Prometheus to scrape."""
+
+    return Response(metrics.render(db.engine), content_type=metrics.CONTENT_TYPE)
+
+
+##############################################################################
+# HTTP caching
+#
+# Static files are fingerprinted and cached long-term; pages are private and
+# revalidated, with ETag / Last-Modified on the views that set them. See
+# http_cache.py for the policy and how to override it per route.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Add caching headers according to the view's cache policy."""
+
+    return apply_cache_policy(response)
@@ -0,0 +1,141 @@
+"""Compare the JSON API's routes with the HTML pages that show the same data.
+
+Each pair fetches the same page of data, logged in as the user who
+follows the most people. <viewer> is that user and <author> is the user
+with the most messages:
+
+- timeline: GET / vs GET /api/v1/timeline
+- messages: GET /users/<author> vs GET /api/v1/users/<author>/messages
+- followers: GET /users/<author>/followers vs
+  GET /api/v1/users/<author>/followers
+- likes: GET /users/<viewer>/likes vs GET /api/v1/users/<viewer>/likes
+- message: GET /messages/<id> vs GET /api/v1/messages/<id>
+
+For each route it reports mean and p95 latency, SQL queries per request
+and response size. Requests run in-process through a Flask test client,
+one at a time, so the numbers are the app + database cost only.
+
+The dataset is loaded into --database-url, which is wiped first unless
+--no-seed is given. Don't point it at a database you care about.
+
+run it like:
+
+    python -m benchmarks.bench_api --profile small --requests 200
+"""
+
+import argparse
+import os
+import time
+
+from benchmarks.load_test import count_query, percentile, seed_dataset, _local
+
+PAIRS = (
+    ('timeline', '/', '/api/v1/timeline'),
+    ('messages', '/users/{author_id}', '/api/v1/users/{author_id}/messages'),
+    ('followers', '/users/{author_id}/followers',
+     '/api/v1/users/{author_id}/followers'),
+    ('likes', '/users/{viewer_id}/likes', '/api/v1/users/{viewer_id}/likes'),
+    ('message', '/messages/{message_id}', '/api/v1/messages/{message_id}'),
+)
+
+
+def pick_subject(app):
+    """The viewer and author described above, and the newest message."""
+
+    from sqlalchemy import select
+    from models import db, User, Message
+
+    with app.app_context():
+        viewer_id = db.session.scalar(
+            select(User.id).order_by(User.following_count.desc()).limit(1))
+        author_id = db.session.scalar(
+            select(User.id).order_by(User.messages_count.desc()).limit(1))
+        message_id = db.session.scalar(
+            select(Message.id).order_by(Message.timestamp.desc()).limit(1))
+
+    if viewer_id is None or message_id is None:
+        raise SystemExit("The database has no users or messages.")
+
+    return dict(viewer_id=viewer_id, author_id=author_id,
+                message_id=message_id)
+
+
+def time_route(client, url, requests):
+    """Fetch `url` `requests` times; return timings, queries and size."""
+
+    timings = []
+    queries = 0
+    size = 0
+
+    for _ in range(requests):
+        _local.queries = 0
+        start = time.perf_counter()
+        # streamed pages render (and query) while their body is read
+        response = client.get(url, buffered=True)
+        timings.append((time.perf_counter() - start) * 1000)
+
+        if response.status_code != 200:
+            raise SystemExit(f"GET {url} returned {response.status_code}.")
+
+        queries += _local.queries
+        size = len(response.data)
+
+    timings.sort()
+    return dict(mean_ms=sum(timings) / len(timings),
+                p95_ms=percentile(timings, 0.95),
+                queries_per_request=queries / requests,
+                bytes=size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///warbler-bench')
+    parser.add_argument('--profile', default='small',
+                        choices=['small', 'medium', 'large'])
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--follows', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the data already in the database')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='untimed requests per route first')
+    args = parser.parse_args()
+
+    # app.py reads the database URL at import time
+    os.environ['DATABASE_URL'] = args.database_url
+    from sqlalchemy import event
+    from app import app, CURR_USER_KEY
+    from models import db
+
+    if not args.no_seed:
+        seed_dataset(args)
+
+    subject = pick_subject(app)
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = subject['viewer_id']
+
+    print(f"{'route':<10} {'kind':<5} {'mean ms':>8} {'p95 ms':>8} "
+          f"{'q/req':>6} {'bytes':>8}")
+
+    for name, html_url, api_url in PAIRS:
+        for kind, url in (('html', html_url), ('api', api_url)):
+            url = url.format(**subject)
+            time_route(client, url, args.warmup)
+            result = time_route(client, url, args.requests)
+
+            print(f"{name:<10} {kind:<5} {result['mean_ms']:>8.2f} "
+                  f"{result['p95_ms']:>8.2f} "
+                  f"{result['queries_per_request']:>6.1f} "
+                  f"{result['bytes']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Benchmark bcrypt throughput per cost factor.
+
+Reports hashes/sec for each cost, both inline and through the hashing pool,
+to help pick BCRYPT_LOG_ROUNDS and PASSWORD_HASH_WORKERS.
+
+run it like:
+
+    python -m benchmarks.bench_hashing --costs 10 11 12 --hashes 16 --workers 4
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from flask import Flask
+
+import hashing
+
+PASSWORD = b"correct horse battery staple"
+
+
+def hashes_per_second(count, hash_one, concurrency=1):
+    """Time `count` calls of `hash_one` spread over `concurrency` threads."""
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as callers:
+        list(callers.map(lambda _: hash_one(), range(count)))
+
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--costs', type=int, nargs='+', default=[10, 11, 12])
+    parser.add_argument('--hashes', type=int, default=16,
+                        help='hashes to time per cost factor')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--executor', choices=['thread', 'process'],
+                        default='thread')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.update(
+        PASSWORD_HASH_EXECUTOR=args.executor,
+        PASSWORD_HASH_WORKERS=args.workers,
+        PASSWORD_HASH_MAX_PENDING=args.hashes,
+        PASSWORD_HASH_WAIT=None,
+    )
+
+    print(f"{'cost':>4}  {'inline/s':>10}  {'pool/s':>10}  {'ms/hash':>8}")
+
+    with app.app_context():
+        pool = hashing.get_pool()
+
+    for cost in args.costs:
+        inline = hashes_per_second(
+            args.hashes,
+            lambda: bcrypt.hashpw(PASSWORD, bcrypt.gensalt(cost)))
+
+        pooled = hashes_per_second(
+            args.hashes,
+            lambda: pool.run(hashing._hash, PASSWORD, cost),
+            concurrency=args.workers)
+
+        print(f"{cost:>4}  {inline:>10.1f}  {pooled:>10.1f}  "
+              f"{1000 / inline:>8.1f}")
+
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Benchmark loading list rows as ORM instances vs read_models tuples.
+
+For a page of the newest messages (with authors) and a page of users, it
+times loading the rows and reading every field a template prints, once
+through `Message` / `User` instances and once through `TimelineItem` /
+`UserCard` tuples. It reports the median ms per page and the peak memory
+Python allocated while building one page.
+
+Reads whatever is already in --database-url; load a dataset first with
+seed.py or benchmarks/load_test.py.
+
+run it like:
+
+    python -m benchmarks.bench_read_models --rows 1000 --repeat 20
+"""
+
+import argparse
+import os
+import statistics
+import time
+import tracemalloc
+
+MESSAGE_FIELDS = ('id', 'text', 'timestamp', 'like_count')
+CARD_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+
+def orm_messages(rows):
+    from models import Message
+
+    messages = (Message.timeline_query()
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(rows).all())
+    for msg in messages:
+        for field in MESSAGE_FIELDS:
+            getattr(msg, field)
+        msg.user.id, msg.user.username, msg.user.image_url
+    return messages
+
+
+def tuple_messages(rows):
+    from models import Message
+    from read_models import TimelineItem
+
+    messages = TimelineItem.from_rows(
+        TimelineItem.query()
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(rows))
+    for msg in messages:
+        for field in MESSAGE_FIELDS:
+            getattr(msg, field)
+        msg.user_id, msg.username, msg.user_image_url
+    return messages
+
+
+def orm_users(rows):
+    from models import User
+
+    users = User.query.order_by(User.id).limit(rows).all()
+    for user in users:
+        for field in CARD_FIELDS:
+            getattr(user, field)
+    return users
+
+
+def tuple_users(rows):
+    from models import db, User
+    from read_models import UserCard
+
+    users = UserCard.from_rows(
+        db.session.execute(UserCard.select().order_by(User.id).limit(rows)))
+    for user in users:
+        for field in CARD_FIELDS:
+            getattr(user, field)
+    return users
+
+
+def measure(load, rows, repeat):
+    """Median ms per call of `load(rows)`, and peak KiB allocated by one."""
+
+    from models import db
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load(rows)
+        timings.append((time.perf_counter() - start) * 1000)
+        # each page is a new request with an empty identity map
+        db.session.remove()
+
+    tracemalloc.start()
+    load(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.remove()
+
+    return statistics.median(timings), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///warbler-bench')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='rows per page')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    # app.py reads the database URL at import time
+    os.environ['DATABASE_URL'] = args.database_url
+    from app import app
+
+    print(f"{'page':<10} {'loader':<7} {'ms':>8} {'peak KiB':>10}")
+
+    with app.app_context():
+        for name, loaders in (('messages', (orm_messages, tuple_messages)),
+                              ('users', (orm_users, tuple_users))):
+            for loader in loaders:
+                # warm up connections and compiled statement caches
+                measure(loader, args.rows, 2)
+                ms, peak = measure(loader, args.rows, args.repeat)
+                kind = loader.__name__.split('_')[0]
+                print(f"{name:<10} {kind:<7} {ms:>8.2f} {peak:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""Load-test Warbler's routes with concurrent logged-in sessions.
+
+Seeds a dataset with generator/create_csvs.py and seed.py, then runs one
+logged-in Flask test client per thread against the real views for a fixed
+time, picking from a weighted mix of actions:
+
+- home: GET /
+- profile: GET /users/<id>
+- user_search: GET /users?q=<username prefix>
+- follow / unfollow: POST both, so the follow graph ends where it began
+- like_toggle: POST /users/add_like/<id> twice, likewise
+- new_message: POST /messages/new
+
+For each route it reports p50/p95/p99 latency, requests/sec and SQL
+queries per request. Requests run in-process (no HTTP server), so the
+numbers are the app + database cost only. Results are saved as JSON;
+--compare diffs two result files and exits non-zero on a regression.
+
+The dataset is loaded into --database-url, which is wiped first unless
+--no-seed is given. Don't point it at a database you care about.
+
+run it like:
+
+    python -m benchmarks.load_test --profile small --sessions 8 --duration 30 \\
+        --output before.json
+    python -m benchmarks.load_test --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ROUTES = ('home', 'profile', 'user_search', 'follow', 'unfollow',
+          'like_toggle', 'new_message')
+
+# relative weights of each action in the mix
+DEFAULT_MIX = dict(home=40, profile=20, user_search=10, follow=10,
+                   like_toggle=10, new_message=10)
+
+# how much worse a route's p95 (or queries/request) can get before
+# --compare calls it a regression
+DEFAULT_THRESHOLD = 0.10
+
+_local = threading.local()
+
+
+def count_query(*args, **kwargs):
+    """SQLAlchemy before_cursor_execute hook: count queries per thread."""
+
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1,
+                       round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+##############################################################################
+# Dataset
+
+
+def seed_dataset(args):
+    """Generate CSVs for the chosen size and load them."""
+
+    from seed import seed
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        command = [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                   '--profile', args.profile, '--seed', str(args.seed),
+                   '--out-dir', data_dir]
+        for kind in ('users', 'messages', 'follows'):
+            if getattr(args, kind) is not None:
+                command += [f'--{kind}', str(getattr(args, kind))]
+
+        subprocess.run(command, check=True)
+        seed(data_dir)
+
+
+def describe_dataset(app, sessions, rng):
+    """Pick session users and search terms; return sizes for the report."""
+
+    from sqlalchemy import func, select
+    from models import db, User, Message, Follows
+
+    with app.app_context():
+        max_user_id = db.session.scalar(select(func.max(User.id))) or 0
+        max_message_id = db.session.scalar(select(func.max(Message.id))) or 0
+
+        if max_user_id < sessions + 1 or not max_message_id:
+            raise SystemExit("Dataset is too small for this many sessions.")
+
+        sample = rng.sample(range(1, max_user_id + 1),
+                            min(max_user_id, sessions + 200))
+        usernames = db.session.scalars(
+            select(User.username).where(User.id.in_(sample[sessions:]))).all()
+
+        return dict(
+            session_user_ids=sample[:sessions],
+            search_terms=[name[:rng.randint(3, 6)] for name in usernames],
+            max_user_id=max_user_id,
+            max_message_id=max_message_id,
+            users=db.session.scalar(select(func.count()).select_from(User)),
+            messages=db.session.scalar(select(func.count()).select_from(Message)),
+            follows=db.session.scalar(select(func.count()).select_from(Follows)),
+        )
+
+
+##############################################################################
+# Sessions
+
+
+class Session:
+    """A logged-in test client that records every request it makes."""
+
+    def __init__(self, app, user_id, dataset, rng):
+        from app import CURR_USER_KEY
+
+        self.app = app
+        self.user_id = user_id
+        self.dataset = dataset
+        self.rng = rng
+        self.records = []
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+
+    def request(self, route, method, url, **kwargs):
+        _local.queries = 0
+        start = time.perf_counter()
+        # streamed pages render (and query) while their body is read, so
+        # buffer it inside the timed region
+        response = self.client.open(url, method=method, buffered=True,
+                                    **kwargs)
+        elapsed = time.perf_counter() - start
+        self.records.append((route, elapsed, _local.queries,
+                             response.status_code))
+
+    def other_user_id(self):
+        while True:
+            user_id = self.rng.randint(1, self.dataset['max_user_id'])
+            if user_id != self.user_id:
+                return user_id
+
+    def home(self):
+        self.request('home', 'GET', '/')
+
+    def profile(self):
+        self.request('profile', 'GET', f'/users/{self.other_user_id()}')
+
+    def user_search(self):
+        term = self.rng.choice(self.dataset['search_terms'])
+        self.request('user_search', 'GET', '/users', query_string={'q': term})
+
+    def follow(self):
+        from models import User
+
+        other_id = self.other_user_id()
+        with self.app.app_context():
+            already_following = User.follows(self.user_id, other_id)
+
+        follow = ('follow', 'POST', f'/users/follow/{other_id}')
+        unfollow = ('unfollow', 'POST', f'/users/stop-following/{other_id}')
+        for action in ((unfollow, follow) if already_following
+                       else (follow, unfollow)):
+            self.request(*action)
+
+    def like_toggle(self):
+        message_id = self.rng.randint(1, self.dataset['max_message_id'])
+        for _ in range(2):
+            self.request('like_toggle', 'POST', f'/users/add_like/{message_id}')
+
+    def new_message(self):
+        self.request('new_message', 'POST', '/messages/new',
+                     data={'text': f'Load test warble {self.rng.random()}'})
+
+
+def run_session(session, mix, deadline):
+    actions = list(mix)
+    weights = [mix[action] for action in actions]
+
+    while time.perf_counter() < deadline:
+        getattr(session, session.rng.choices(actions, weights)[0])()
+
+
+def run_load(app, dataset, args, mix):
+    """Run every session until the deadline; return all request records."""
+
+    sessions = [Session(app, user_id, dataset, Random(f"{args.seed}:{index}"))
+                for index, user_id in enumerate(dataset['session_user_ids'])]
+
+    for session in sessions:
+        run_session(session, mix,
+                    time.perf_counter() + args.warmup / len(sessions))
+        session.records.clear()
+
+    deadline = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=run_session,
+                                args=(session, mix, deadline))
+               for session in sessions]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return [record for session in sessions for record in session.records], elapsed
+
+
+def summarize(records, elapsed):
+    """Per-route latency percentiles (ms), throughput and queries/request."""
+
+    by_route = defaultdict(list)
+    for route, latency, queries, status in records:
+        by_route[route].append((latency, queries, status))
+
+    summary = {}
+    for route in ROUTES:
+        samples = by_route.get(route)
+        if not samples:
+            continue
+
+        latencies = sorted(latency * 1000 for latency, _, _ in samples)
+        summary[route] = dict(
+            requests=len(samples),
+            errors=sum(1 for _, _, status in samples if status >= 500),
+            rps=len(samples) / elapsed,
+            p50_ms=percentile(latencies, 0.50),
+            p95_ms=percentile(latencies, 0.95),
+            p99_ms=percentile(latencies, 0.99),
+            mean_ms=sum(latencies) / len(latencies),
+            queries_per_request=(sum(queries for _, queries, _ in samples)
+                                 / len(samples)),
+        )
+
+    return summary
+
+
+##############################################################################
+# Reporting
+
+
+def print_summary(summary, elapsed):
+    print(f"\n{'route':<12} {'reqs':>7} {'err':>4} {'rps':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'q/req':>6}")
+    for route, stats in summary.items():
+        print(f"{route:<12} {stats['requests']:>7} {stats['errors']:>4} "
+              f"{stats['rps']:>8.1f} {stats['p50_ms']:>8.1f} "
+              f"{stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} "
+              f"{stats['queries_per_request']:>6.1f}")
+
+    total = sum(stats['requests'] for stats in summary.values())
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} rps)")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path, threshold):
+    """Print per-route changes between two result files.
+
+    Returns True if any route's p95 latency or queries/request got worse by
+    more than `threshold` (a fraction), or it started returning errors.
+    """
+
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    print(f"{'route':<12} {'p95 old':>8} {'p95 new':>8} {'change':>8} "
+          f"{'rps old':>8} {'rps new':>8} {'q/req':>11}")
+
+    regressed = False
+    for route in ROUTES:
+        if route not in old['routes'] or route not in new['routes']:
+            continue
+
+        before, after = old['routes'][route], new['routes'][route]
+        change = after['p95_ms'] / before['p95_ms'] - 1
+        worse = (change > threshold
+                 or after['queries_per_request']
+                 > before['queries_per_request'] * (1 + threshold)
+                 or after['errors'] > before['errors'])
+        regressed = regressed or worse
+
+        print(f"{route:<12} {before['p95_ms']:>8.1f} {after['p95_ms']:>8.1f} "
+              f"{change:>+8.0%} {before['rps']:>8.1f} {after['rps']:>8.1f} "
+              f"{before['queries_per_request']:>5.1f}->"
+              f"{after['queries_per_request']:<5.1f}"
+              f"{'  REGRESSION' if worse else ''}")
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///warbler-bench')
+    parser.add_argument('--profile', default='small',
+                        choices=['small', 'medium', 'large'])
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--follows', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the data already in the database')
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run the load for')
+    parser.add_argument('--warmup', type=float, default=3,
+                        help='seconds of untimed single-threaded warmup')
+    parser.add_argument('--mix', type=json.loads, default=DEFAULT_MIX,
+                        help='JSON dict of action weights')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='diff two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    # app.py reads the database URL at import time
+    os.environ['DATABASE_URL'] = args.database_url
+    from sqlalchemy import event
+    from app import app
+    from models import db
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    if not args.no_seed:
+        seed_dataset(args)
+
+    rng = Random(args.seed)
+    dataset = describe_dataset(app, args.sessions, rng)
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+
+    records, elapsed = run_load(app, dataset, args, args.mix)
+    summary = summarize(records, elapsed)
+    print_summary(summary, elapsed)
+
+    if args.output:
+        result = dict(
+            revision=git_revision(),
+            recorded_at=datetime.now(timezone.utc).isoformat(),
+            settings=dict(profile=args.profile, seed=args.seed,
+                          sessions=args.sessions, duration=args.duration,
+                          mix=args.mix),
+            dataset={key: dataset[key]
+                     for key in ('users', 'messages', 'follows')},
+            elapsed=elapsed,
+            routes=summary,
+        )
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Cached snapshot of the logged-in user.
+
+`add_user_to_g` used to load the full `User` row on every request. Most
+requests only read a handful of columns (for the navbar and home card), so
+we keep a small read-only snapshot per user id in a process-local TTL
+cache. Views that change the user go through `CurrentUser.model`, which
+loads the ORM object on first use.
+
+Routes that change a snapshot's fields call `invalidate` for the affected
+user ids. Other worker processes only see the change once their copy
+expires, so CURRENT_USER_CACHE_TTL bounds how stale a snapshot can get.
+"""
+
+import time
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, User
+
+
+class CurrentUser:
+    """Read-only snapshot of the columns views read from `g.user`."""
+
+    FIELDS = (
+        'id',
+        'username',
+        'image_url',
+        'header_image_url',
+        'messages_count',
+        'followers_count',
+        'following_count',
+        'likes_count',
+    )
+
+    __slots__ = FIELDS + ('_model',)
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields[field])
+        self._model = None
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @property
+    def model(self):
+        """The full `User` for this snapshot, loaded on first access."""
+
+        if self._model is None:
+            self._model = db.get_or_404(User, self.id)
+        return self._model
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return User.follows(self.id, other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Return the subset of `user_ids` that this user follows."""
+
+        return User.followed_ids_among(self.id, user_ids)
+
+
+class SnapshotCache:
+    """Thread-safe TTL cache of snapshot fields keyed by user id."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+        if entry is None:
+            return None
+
+        expires_at, fields = entry
+        if expires_at < time.monotonic():
+            self.invalidate(user_id)
+            return None
+
+        return fields
+
+    def put(self, user_id, fields, ttl):
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[user_id] = (time.monotonic() + ttl, fields)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+snapshots = SnapshotCache()
+
+
+def load_current_user(user_id):
+    """Return a `CurrentUser` for `user_id`, or None if there is no such
+    user or they deactivated their account.
+
+    Served from the cache when possible; otherwise reads only the snapshot
+    columns from the database.
+    """
+
+    ttl = current_app.config['CURRENT_USER_CACHE_TTL']
+    fields = snapshots.get(user_id) if ttl else None
+
+    if fields is None:
+        columns = [getattr(User, field) for field in CurrentUser.FIELDS]
+        row = db.session.execute(
+            select(*columns)
+            .where(User.id == user_id)
+            .where(User.deactivated_at.is_(None))).first()
+
+        if row is None:
+            return None
+
+        fields = row._asdict()
+        if ttl:
+            snapshots.put(user_id, fields, ttl)
+
+    return CurrentUser(**fields)
+
+
+def invalidate(*user_ids):
+    """Drop cached snapshots for `user_ids` after their fields change."""
+
+    snapshots.invalidate(*user_ids)
@@ -3,14 +3,35 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Rows are written straight to disk in fixed-size shards, which can be spread
+across worker processes. Each shard has its own random seed, so the output
+only depends on the profile and --seed, not on the number of workers.
+Nothing is fetched over the network.
+
+- Followers follow a power law: a few users are followed by a large share
+  of everyone, and how many users each person follows is heavy-tailed too.
+- Messages come in bursts: an author posts a run of messages minutes
+  apart, at a random point in the last two years. Prolific authors are
+  also power-law distributed.
+
+run it like:
+
+    python generator/create_csvs.py [--profile small] [--seed 0] [--workers 4]
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import PowerLawSampler, get_burst_datetimes
 
 MAX_WARBLER_LENGTH = 140
 
@@ -18,13 +39,26 @@ USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'heade
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+PROFILES = {
+    'small': dict(users=300, messages=1000, follows=5000),
+    'medium': dict(users=100_000, messages=2_000_000, follows=10_000_000),
+    'large': dict(users=2_000_000, messages=50_000_000, follows=200_000_000),
+}
+
+# rows (or, for follows, followers) per shard
+SHARD_SIZES = dict(users=20_000, messages=200_000, follows=20_000)
 
-fake = Faker()
+# timestamps end here so output doesn't depend on when it's generated
+END_DATETIME = datetime(2024, 1, 1)
 
-# Generate random profile image URLs to use for users
+FOLLOWER_EXPONENT = 1.0
+AUTHOR_EXPONENT = 0.8
+FOLLOWING_PARETO_ALPHA = 2.0
+MEAN_BURST_LENGTH = 4
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +66,194 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (the splashbase images used so far)
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{name}_1280.jpg"
+    for name in """
+        mnh0n9pHJW1st5lhmo1 mnh0uemhCk1st5lhmo1 mnh121HEWa1st5lhmo1
+        mnh17lfd9R1st5lhmo1 mnh1d7s3UD1st5lhmo1 mnh1jdFvHR1st5lhmo1
+        mnh1uhYnog1st5lhmo1 mnh25vNOvI1st5lhmo1 mnh29fxz111st5lhmo1
+        mnh2m1hnS81st5lhmo1 mo1h6tGOZf1st5lhmo1 mo2wz2LTCs1st5lhmo1
+        mo2x3aAnRH1st5lhmo1 mo2x80NkDu1st5lhmo1 mo2x9xqeef1st5lhmo1
+        mo2xbk8JUK1st5lhmo1 mo2xdqmle51st5lhmo1 mo2xfarCvW1st5lhmo1
+        mo2xgqdEFn1st5lhmo1 mo2xijE2nr1st5lhmo1 mopq4kHmAg1st5lhmo1
+        mopq69jlcS1st5lhmo1 mopq8fyQwI1st5lhmo1 mopqamedKu1st5lhmo1
+        mopqc3ZZcz1st5lhmo1 mopqdfx05t1st5lhmo1 mopqfpSTPN1st5lhmo1
+        mopqhxFulr1st5lhmo1 mopqj9QUeq1st5lhmo1 mopqkkwK2M1st5lhmo1
+        mp6rzyNlAN1st5lhmo1 mp6s1hAudo1st5lhmo1 mp6s32zb6l1st5lhmo1
+        mp6s4dzqHA1st5lhmo1 mp6s661UgK1st5lhmo1 mp6s7lR1lS1st5lhmo1
+        mp6s995bvI1st5lhmo1 mp6sasSvPZ1st5lhmo1 mp6scv2xrZ1st5lhmo1
+        mpp6f50W261st5lhmo1 mpp6gwrYvm1st5lhmo1 mpp6l06zXi1st5lhmo1
+        mpp6poZxE51st5lhmo1 mpp6tjdFhf1st5lhmo1 mpp6w0dxAm1st5lhmo1
+    """.split()
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+_samplers = {}
+
+
+def get_sampler(n, exponent):
+    """Per-process cache of power-law samplers (they cost O(n) to build)."""
+
+    key = (n, exponent)
+    if key not in _samplers:
+        _samplers[key] = PowerLawSampler(n, exponent)
+    return _samplers[key]
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+def shard_rng(seed, kind, index):
+    return Random(f"{seed}:{kind}:{index}")
+
+
+def write_users(writer, rng, start, stop, options):
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    for user_id in range(start + 1, stop + 1):
+        # the id suffix keeps usernames (and emails) unique at any size
+        username = f"{fake.user_name()}{user_id}"
+        writer.writerow((
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def write_messages(writer, rng, start, stop, options):
+    words = Faker().get_words_list()
+    authors = get_sampler(options['users'], AUTHOR_EXPONENT)
+    remaining = stop - start
+
+    while remaining:
+        burst = min(remaining,
+                    1 + int(rng.expovariate(1 / (MEAN_BURST_LENGTH - 1))))
+        user_id = authors(rng)
+
+        for timestamp in get_burst_datetimes(burst, rng, END_DATETIME):
+            text = ' '.join(rng.choices(words, k=rng.randint(4, 24)))
+            writer.writerow((
+                f"{text.capitalize()[:MAX_WARBLER_LENGTH - 1]}.",
+                timestamp,
+                user_id,
+            ))
+
+        remaining -= burst
+
+
+def write_follows(writer, rng, start, stop, options):
+    num_users = options['users']
+    followed = get_sampler(num_users, FOLLOWER_EXPONENT)
+
+    # Pareto(alpha) has mean alpha / (alpha - 1); scale it to the target
+    alpha = FOLLOWING_PARETO_ALPHA
+    scale = options['follows'] / num_users * (alpha - 1) / alpha
+
+    for follower in range(start + 1, stop + 1):
+        wanted = min(num_users - 1, round(rng.paretovariate(alpha) * scale))
+        following = set()
+
+        # popular users get drawn over and over; give up on the long tail
+        for _ in range(wanted * 10):
+            if len(following) == wanted:
+                break
+            user_id = followed(rng)
+            if user_id != follower:
+                following.add(user_id)
+
+        for user_id in sorted(following):
+            writer.writerow((user_id, follower))
+
+
+WRITERS = {
+    'users': write_users,
+    'messages': write_messages,
+    'follows': write_follows,
+}
+
+
+def write_shard(task):
+    """Write one shard to its own file; return (path, rows written)."""
+
+    kind, index, start, stop, options, path = task
+    rng = shard_rng(options['seed'], kind, index)
+
+    with open(path, 'w', newline='') as shard_csv:
+        writer = CountingWriter(csv.writer(shard_csv))
+        WRITERS[kind](writer, rng, start, stop, options)
+
+    return path, writer.rows
+
+
+class CountingWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows = 0
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.rows += 1
+
+
+def generate(kind, headers, total, options, pool, out_dir):
+    """Write `out_dir/<kind>.csv` from shards of `total` rows (or followers)."""
+
+    start_time = time.perf_counter()
+    shard_size = SHARD_SIZES[kind]
+    parts_dir = tempfile.mkdtemp(prefix=f".{kind}-", dir=out_dir)
+
+    tasks = [
+        (kind, index, start, min(start + shard_size, total), options,
+         os.path.join(parts_dir, f"{index:06}.csv"))
+        for index, start in enumerate(range(0, total, shard_size))
+    ]
+
+    rows = 0
+    with open(os.path.join(out_dir, f"{kind}.csv"), 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+
+        # imap keeps shard order, so the output doesn't depend on timing
+        for path, count in pool.imap(write_shard, tasks):
+            with open(path, newline='') as part:
+                shutil.copyfileobj(part, out)
+            os.remove(path)
+            rows += count
+            print(f"  {kind}: {rows:,} rows", end='\r', flush=True)
+
+    os.rmdir(parts_dir)
+    elapsed = time.perf_counter() - start_time
+    print(f"  {kind}: {rows:,} rows in {elapsed:.1f}s "
+          f"({rows / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--profile', choices=PROFILES, default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out-dir', default='generator')
+    for kind in PROFILES['small']:
+        parser.add_argument(f'--{kind}', type=int,
+                            help=f"override the profile's number of {kind}")
+    args = parser.parse_args()
+
+    options = dict(PROFILES[args.profile], seed=args.seed)
+    for kind in PROFILES['small']:
+        if getattr(args, kind) is not None:
+            options[kind] = getattr(args, kind)
+
+    with Pool(args.workers) as pool:
+        generate('users', USERS_CSV_HEADERS, options['users'],
+                 options, pool, args.out_dir)
+        generate('messages', MESSAGES_CSV_HEADERS, options['messages'],
+                 options, pool, args.out_dir)
+        # follows are sharded by follower, with a target average per follower
+        generate('follows', FOLLOWS_CSV_HEADERS, options['users'],
+                 options, pool, args.out_dir)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
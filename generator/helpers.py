@@ -1,14 +1,63 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from array import array
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the last few years.
 
-    now = datetime.now()
+    Pass a seeded `random.Random` as `rng` and a fixed `now` to get the
+    same datetimes on every run.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def get_burst_datetimes(count, rng=random, now=None, year_gap=2, mean_gap=90):
+    """Get `count` datetimes clustered in one burst of activity.
+
+    The burst starts at a random point in the last few years, and the gaps
+    between datetimes are exponential with a mean of `mean_gap` seconds.
+    """
+
+    timestamp = get_random_datetime(year_gap, rng, now)
+    datetimes = []
+
+    for _ in range(count):
+        datetimes.append(timestamp)
+        timestamp += timedelta(seconds=rng.expovariate(1 / mean_gap))
+
+    return datetimes
+
+
+class PowerLawSampler:
+    """Draw ids 1..n where the k-th most popular id has weight 1 / k**exponent.
+
+    Popularity ranks are scattered across ids with a fixed stride, so the
+    most popular users aren't simply the lowest ids. Memory is O(n).
+    """
+
+    def __init__(self, n, exponent=1.0, scatter=0.618):
+        self.n = n
+        self.cumulative = array(
+            'd', accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+        self.total = self.cumulative[-1]
+
+        stride = max(1, int(n * scatter))
+        while gcd(stride, n) != 1:
+            stride += 1
+        self.stride = stride
+
+    def __call__(self, rng=random):
+        rank = min(bisect(self.cumulative, rng.random() * self.total),
+                   self.n - 1)
+        return rank * self.stride % self.n + 1
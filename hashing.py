@@ -0,0 +1,130 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow: each hash or check costs hundreds of ms of CPU
+at the default cost factor. Run inline, a burst of logins ties up every
+request worker. Here the work runs on a fixed-size pool (threads by
+default; bcrypt releases the GIL), and at most PASSWORD_HASH_MAX_PENDING
+jobs may be queued or running at once. Past that, callers get
+`HashingPoolBusy` instead of piling up behind the queue.
+
+Settings (read from the Flask config):
+
+- BCRYPT_LOG_ROUNDS: bcrypt cost factor for new hashes.
+- PASSWORD_HASH_EXECUTOR: 'thread' or 'process'.
+- PASSWORD_HASH_WORKERS: pool size.
+- PASSWORD_HASH_MAX_PENDING: queued + running jobs allowed.
+- PASSWORD_HASH_WAIT: seconds to wait for a free slot before giving up.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+from flask import current_app
+
+
+class HashingPoolBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password, pw_hash)
+
+
+class HashingPool:
+    """A fixed-size executor with a cap on queued + running jobs."""
+
+    def __init__(self, workers, max_pending, kind='thread'):
+        executor_class = (ProcessPoolExecutor if kind == 'process'
+                          else ThreadPoolExecutor)
+        self.executor = executor_class(max_workers=workers)
+        self.max_pending = max_pending
+        self._slots = BoundedSemaphore(max_pending)
+        self._lock = Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self, fn, *args, wait=None):
+        """Run `fn(*args)` on the pool and return its result.
+
+        Raises HashingPoolBusy if no slot frees up within `wait` seconds.
+        """
+
+        if not self._slots.acquire(timeout=wait):
+            with self._lock:
+                self.rejected += 1
+            raise HashingPoolBusy()
+
+        with self._lock:
+            self.pending += 1
+
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+            self._slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """Return this process's hashing pool, creating it on first use."""
+
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                config = current_app.config
+                workers = config['PASSWORD_HASH_WORKERS'] or os.cpu_count()
+                _pool = HashingPool(
+                    workers,
+                    config['PASSWORD_HASH_MAX_PENDING'] or workers * 4,
+                    config['PASSWORD_HASH_EXECUTOR'],
+                )
+
+    return _pool
+
+
+def queue_depth():
+    """Number of hashing jobs currently queued or running."""
+
+    return _pool.pending if _pool else 0
+
+
+def _encode(password):
+    if not password:
+        raise ValueError('Password must be non-empty.')
+
+    return password.encode('UTF-8') if isinstance(password, str) else password
+
+
+def generate_password_hash(password):
+    """Hash `password` with the configured cost factor."""
+
+    return get_pool().run(_hash, _encode(password),
+                          current_app.config['BCRYPT_LOG_ROUNDS'],
+                          wait=current_app.config['PASSWORD_HASH_WAIT'])
+
+
+def check_password_hash(pw_hash, password):
+    """Does `password` match the bcrypt hash `pw_hash`?"""
+
+    if not password:
+        return False
+
+    return get_pool().run(_check, _encode(pw_hash), _encode(password),
+                          wait=current_app.config['PASSWORD_HASH_WAIT'])
@@ -0,0 +1,162 @@
+"""HTTP caching policy for Warbler responses.
+
+- Static files linked through `static_url` carry a content hash (`?v=`) and
+  are cached for a year; unversioned static URLs get a short max-age.
+- Pages are personalized by the session cookie, so by default they are
+  `private, no-cache` with `Vary: Cookie`: browsers may keep a copy but
+  must revalidate it, and shared caches must not serve it to anyone else.
+- Views that can cheaply tell whether a page changed call
+  `conditional_response` before rendering; it answers 304 Not Modified
+  when the client's ETag / Last-Modified still match. Validators include
+  the deployed code's version, so a deploy that changes the HTML (or the
+  `?v=` assets it links) invalidates every cached page.
+
+A view's policy is set with the `cache_policy` decorator and can be
+overridden per endpoint with the CACHE_POLICIES config dict.
+"""
+
+import hashlib
+import os
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from flask import current_app, g, request, session, url_for
+
+DEFAULT_POLICY = ('private, no-cache', ('Cookie',))
+STATIC_POLICY = 'public, max-age=31536000, immutable'
+UNVERSIONED_STATIC_POLICY = 'public, max-age=3600'
+UNSAFE_METHOD_POLICY = 'no-store'
+
+VIEWER_FIELDS = ('id', 'username', 'image_url', 'header_image_url',
+                 'messages_count', 'followers_count', 'following_count')
+
+
+def cache_policy(cache_control, vary=('Cookie',)):
+    """Set the Cache-Control value (and Vary headers) for a view's GETs."""
+
+    def decorator(view):
+        view.cache_policy = (cache_control, tuple(vary))
+        return view
+
+    return decorator
+
+
+@lru_cache(maxsize=None)
+def _fingerprint(path, mtime):
+    with open(path, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()[:12]
+
+
+def static_url(filename):
+    """URL for a static file, fingerprinted with a hash of its contents."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    version = _fingerprint(path, os.path.getmtime(path))
+    return url_for('static', filename=filename, v=version)
+
+
+_deployed_at = {}
+
+
+def _newest_mtime(app):
+    paths = [entry.path for entry in os.scandir(app.root_path)
+             if entry.name.endswith('.py')]
+    for folder in (os.path.join(app.root_path, app.template_folder),
+                   app.static_folder):
+        for root, _, files in os.walk(folder):
+            paths.extend(os.path.join(root, name) for name in files)
+
+    mtime = max(os.path.getmtime(path) for path in paths)
+    return datetime.fromtimestamp(int(mtime), timezone.utc)
+
+
+def deployed_at():
+    """When the running code was deployed, as a UTC datetime.
+
+    That's the newest modification time of the app's modules, templates and
+    static files. It's read once per process, or on every call while
+    templates auto-reload (in debug), since then they change under it.
+    """
+
+    app = current_app._get_current_object()
+    if app.jinja_env.auto_reload or app not in _deployed_at:
+        _deployed_at[app] = _newest_mtime(app)
+    return _deployed_at[app]
+
+
+def deploy_version():
+    """The RELEASE_VERSION config, or else the deploy time, as a string."""
+
+    return current_app.config.get('RELEASE_VERSION') or deployed_at().isoformat()
+
+
+def conditional_response(*parts, last_modified=None):
+    """Return a 304 response if the client's copy is current, else None.
+
+    The ETag is a hash of `parts`, the deploy version and the viewer's
+    snapshot fields (they appear in the navbar and home card).
+    `last_modified` is a naive UTC or aware datetime; it's moved up to the
+    deploy time if older. The validators are also added to the full
+    response.
+    """
+
+    # a pending flash message is part of the page but not of the ETag
+    if session.get('_flashes'):
+        return None
+
+    viewer = (tuple(getattr(g.user, field) for field in VIEWER_FIELDS)
+              if g.get('user') else None)
+    etag = hashlib.sha1(
+        repr((deploy_version(), parts, viewer)).encode()).hexdigest()
+
+    if last_modified is not None:
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        last_modified = max(last_modified.replace(microsecond=0),
+                            deployed_at())
+
+    g.cache_validators = (etag, last_modified)
+
+    if request.if_none_match:
+        matches = request.if_none_match.contains(etag)
+    else:
+        matches = (last_modified is not None
+                   and request.if_modified_since is not None
+                   and last_modified <= request.if_modified_since)
+
+    if matches:
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def apply_cache_policy(response):
+    """Set Cache-Control, Vary and validators on an outgoing response."""
+
+    if request.endpoint == 'static':
+        response.headers['Cache-Control'] = (
+            STATIC_POLICY if request.args.get('v')
+            else UNVERSIONED_STATIC_POLICY)
+        return response
+
+    if request.method not in ('GET', 'HEAD'):
+        response.headers['Cache-Control'] = UNSAFE_METHOD_POLICY
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+    cache_control, vary = getattr(view, 'cache_policy', DEFAULT_POLICY)
+    cache_control = current_app.config['CACHE_POLICIES'].get(
+        request.endpoint, cache_control)
+
+    response.headers['Cache-Control'] = cache_control
+    for header in vary:
+        response.vary.add(header)
+
+    validators = g.get('cache_validators')
+    if validators and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+
+    return response
@@ -0,0 +1,226 @@
+"""Per-request query counts and timings, exposed in Prometheus text format.
+
+SQLAlchemy engine events count the queries each request runs and the time
+spent in them; Flask signals time template rendering. At the end of a
+request the totals are added to histograms labelled with the Flask
+endpoint, so an N+1 shows up as a jump in that endpoint's queries per
+request. `render` produces the /metrics page, which also reports the
+database connection pool and the password hashing queue.
+
+Statements run outside a request (CLI commands, tests' setup) are not
+counted. Other modules can watch every statement with `on_query`.
+"""
+
+import time
+from threading import Lock
+
+from flask import (before_render_template, g, has_request_context, request,
+                   template_rendered)
+from sqlalchemy import event
+
+import hashing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def _label_value(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{_label_value(value)}"'
+                     for name, value in labels)
+    return '{' + pairs + '}'
+
+
+class Histogram:
+    """A thread-safe Prometheus histogram with one label."""
+
+    def __init__(self, name, help, buckets, label):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [
+                    [0] * len(self.buckets), 0.0, 0]
+
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series = sorted((key, list(counts), total, count)
+                            for key, (counts, total, count)
+                            in self._series.items())
+
+        for label_value, counts, total, count in series:
+            label = (self.label, label_value)
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels((label, ('le', bound)))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels((label, ('le', '+Inf')))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels((label,))} {total}")
+            lines.append(f"{self.name}_count{_format_labels((label,))} {count}")
+
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+request_duration = Histogram(
+    'warbler_request_duration_seconds',
+    'Time to handle a request.', LATENCY_BUCKETS, 'endpoint')
+request_queries = Histogram(
+    'warbler_request_queries',
+    'SQL statements run by a request.', QUERY_BUCKETS, 'endpoint')
+request_db_duration = Histogram(
+    'warbler_request_db_seconds',
+    'Time a request spent waiting on SQL statements.', LATENCY_BUCKETS,
+    'endpoint')
+template_duration = Histogram(
+    'warbler_template_render_seconds',
+    'Time to render a template.', LATENCY_BUCKETS, 'template')
+
+HISTOGRAMS = (request_duration, request_queries, request_db_duration,
+              template_duration)
+
+_query_listeners = []
+
+
+def on_query(listener):
+    """Call `listener(conn, statement, parameters, duration)` after each query."""
+
+    _query_listeners.append(listener)
+    return listener
+
+
+##############################################################################
+# Hooks
+
+
+# Start times are keyed by cursor: statements run from a query listener
+# (e.g. an EXPLAIN) nest inside another's after_cursor_execute.
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_times', {})[id(cursor)] = (
+        time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = (time.perf_counter()
+                - conn.info['query_start_times'].pop(id(cursor)))
+
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_queries += 1
+        g.metrics_db_time += duration
+
+    for listener in _query_listeners:
+        listener(conn, statement, parameters, duration)
+
+
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute; drop its start
+    # time so it doesn't stay on the pooled connection
+    execution = context.execution_context
+    if context.connection is not None and execution is not None:
+        context.connection.info.get('query_start_times', {}).pop(
+            id(execution.cursor), None)
+
+
+def _before_render_template(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('metrics_template_starts', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    starts = g.get('metrics_template_starts') if has_request_context() else None
+    if starts:
+        template_duration.observe(template.name,
+                                  time.perf_counter() - starts.pop())
+
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_db_time = 0.0
+
+
+def finish_request(exception=None):
+    if 'metrics_start' not in g:
+        return
+
+    endpoint = request.endpoint or 'unmatched'
+    request_duration.observe(endpoint, time.perf_counter() - g.metrics_start)
+    request_queries.observe(endpoint, g.metrics_queries)
+    request_db_duration.observe(endpoint, g.metrics_db_time)
+    del g.metrics_start
+
+
+def init_app(app, engine):
+    """Attach the request, template and engine hooks."""
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
+
+
+##############################################################################
+# Exposition
+
+
+def _gauge(name, help, value):
+    return [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+
+def render(engine):
+    """The /metrics page: histograms, pool usage and hashing queue depth."""
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+
+    pool = engine.pool
+    for name, help, attribute in (
+            ('warbler_db_pool_size', 'Configured connection pool size.',
+             'size'),
+            ('warbler_db_pool_checked_out', 'Connections currently in use.',
+             'checkedout'),
+            ('warbler_db_pool_overflow', 'Connections open beyond the pool size.',
+             'overflow')):
+        if hasattr(pool, attribute):
+            # overflow() counts down from -size until the pool fills up
+            lines += _gauge(name, help, max(0, getattr(pool, attribute)()))
+
+    lines += _gauge('warbler_password_hash_queue_depth',
+                    'Password hashing jobs queued or running.',
+                    hashing.queue_depth())
+
+    return '\n'.join(lines) + '\n'
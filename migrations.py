@@ -0,0 +1,298 @@
+"""Bring an existing database up to date with models.py, keeping its data.
+
+`db.create_all()` only creates missing tables, so schema changes to tables
+that already hold data go here. Each migration inspects the database and
+only does what's missing, so `flask migrate` is safe to run repeatedly and
+on databases that were created fresh from the current models. Migrations
+run in the order they're defined here.
+
+Tables added since the database was created are created, and filled in
+from the rows they're derived from. Indexes declared in models.py but
+missing from the database are built with CREATE INDEX CONCURRENTLY on
+Postgres, which doesn't block reads or writes on the table while it runs.
+"""
+
+from flask import current_app
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from models import db, Likes, TimelineEntry, MessageTerm
+from search import (USER_SEARCH_COLUMNS, create_user_search_index,
+                    rebuild_message_index, user_search_index_ddl)
+
+MIGRATIONS = []
+
+USER_COUNTERS = ('messages_count', 'followers_count', 'following_count',
+                 'likes_count')
+
+
+def migration(fn):
+    """Register `fn(engine, echo)` to run, in definition order, on migrate."""
+
+    MIGRATIONS.append(fn)
+    return fn
+
+
+def run(engine, echo=print):
+    """Apply every migration to `engine`'s database."""
+
+    for fn in MIGRATIONS:
+        fn(engine, echo)
+
+
+def _drop_invalid_indexes(connection, names, echo):
+    """Drop indexes left INVALID by an interrupted concurrent build."""
+
+    invalid = connection.execute(text(
+        "SELECT class.relname FROM pg_index "
+        "JOIN pg_class class ON class.oid = pg_index.indexrelid "
+        "WHERE NOT pg_index.indisvalid AND class.relname = ANY(:names)"),
+        {'names': list(names)}).scalars().all()
+
+    for name in invalid:
+        echo(f"Dropping invalid index {name}")
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+
+
+def _columns(inspector, table):
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+@migration
+def restructure_likes(engine, echo=print):
+    """Key likes by (user_id, message_id) and record when each was made.
+
+    Likes used to have a surrogate id and a unique message_id (so each
+    message could only be liked once). Existing likes keep their users and
+    messages; their liked_at is the time of the migration. On Postgres this
+    holds a lock on `likes` while the new primary key is built.
+    """
+
+    inspector = inspect(engine)
+    if ('likes' not in inspector.get_table_names()
+            or 'id' not in _columns(inspector, 'likes')):
+        return
+
+    echo("Restructuring likes")
+
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            connection.execute(text(
+                "DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL"))
+            connection.execute(text(
+                "DELETE FROM likes a USING likes b "
+                "WHERE a.user_id = b.user_id AND a.message_id = b.message_id "
+                "AND a.id > b.id"))
+
+            constraints = [inspector.get_pk_constraint('likes')['name']]
+            constraints += [constraint['name'] for constraint
+                            in inspector.get_unique_constraints('likes')]
+            for name in constraints:
+                connection.execute(text(
+                    f'ALTER TABLE likes DROP CONSTRAINT "{name}"'))
+
+            connection.execute(text(
+                "DROP INDEX IF EXISTS ix_likes_user_id_message_id"))
+            connection.execute(text(
+                "ALTER TABLE likes "
+                "DROP COLUMN id, "
+                "ALTER COLUMN user_id SET NOT NULL, "
+                "ALTER COLUMN message_id SET NOT NULL, "
+                "ADD COLUMN IF NOT EXISTS liked_at TIMESTAMP NOT NULL "
+                "DEFAULT now(), "
+                "ADD PRIMARY KEY (user_id, message_id)"))
+
+        else:
+            # SQLite can't change a table's keys in place, so copy it
+            connection.execute(text(
+                "DROP INDEX IF EXISTS ix_likes_user_id_message_id"))
+            connection.execute(text("ALTER TABLE likes RENAME TO likes_old"))
+            Likes.__table__.create(connection)
+            connection.execute(text(
+                "INSERT INTO likes (user_id, message_id) "
+                "SELECT DISTINCT user_id, message_id FROM likes_old "
+                "WHERE user_id IS NOT NULL AND message_id IS NOT NULL"))
+            connection.execute(text("DROP TABLE likes_old"))
+
+
+@migration
+def add_message_like_count(engine, echo=print):
+    """Add messages.like_count and fill it in from likes."""
+
+    inspector = inspect(engine)
+    if ('messages' not in inspector.get_table_names()
+            or 'like_count' in _columns(inspector, 'messages')):
+        return
+
+    echo("Adding messages.like_count")
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "ALTER TABLE messages "
+            "ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0"))
+        connection.execute(text(
+            "UPDATE messages SET like_count = ("
+            "SELECT count(*) FROM likes WHERE likes.message_id = messages.id) "
+            "WHERE id IN (SELECT message_id FROM likes)"))
+
+
+@migration
+def add_user_counters(engine, echo=print):
+    """Add the users' denormalized counters and fill them in."""
+
+    inspector = inspect(engine)
+    if ('users' not in inspector.get_table_names()
+            or 'messages_count' in _columns(inspector, 'users')):
+        return
+
+    echo(f"Adding users.{', '.join(USER_COUNTERS)}")
+
+    with engine.begin() as connection:
+        for column in USER_COUNTERS:
+            connection.execute(text(
+                f"ALTER TABLE users "
+                f"ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+
+        connection.execute(text(
+            "UPDATE users SET "
+            "messages_count = (SELECT count(*) FROM messages "
+            "WHERE messages.user_id = users.id), "
+            "followers_count = (SELECT count(*) FROM follows "
+            "WHERE follows.user_being_followed_id = users.id), "
+            "following_count = (SELECT count(*) FROM follows "
+            "WHERE follows.user_following_id = users.id), "
+            "likes_count = (SELECT count(*) FROM likes "
+            "WHERE likes.user_id = users.id)"))
+
+
+@migration
+def add_user_deactivated_at(engine, echo=print):
+    """Add users.deactivated_at, set on accounts waiting to be purged."""
+
+    inspector = inspect(engine)
+    if ('users' not in inspector.get_table_names()
+            or 'deactivated_at' in _columns(inspector, 'users')):
+        return
+
+    echo("Adding users.deactivated_at")
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "ALTER TABLE users ADD COLUMN deactivated_at TIMESTAMP"))
+
+
+@migration
+def create_timelines(engine, echo=print):
+    """Create the home timelines table and fill it from messages and follows."""
+
+    if TimelineEntry.__tablename__ in inspect(engine).get_table_names():
+        return
+
+    echo("Creating timelines")
+
+    TimelineEntry.__table__.create(engine)
+    TimelineEntry.rebuild(current_app.config['TIMELINE_FANOUT_LIMIT'],
+                          current_app.config['TIMELINE_BACKFILL_SIZE'])
+    db.session.commit()
+
+
+@migration
+def create_message_terms(engine, echo=print):
+    """Create the message search index table and index every message."""
+
+    if MessageTerm.__tablename__ in inspect(engine).get_table_names():
+        return
+
+    echo("Creating message_terms")
+
+    MessageTerm.__table__.create(engine)
+    rebuild_message_index()
+    db.session.commit()
+
+
+@migration
+def create_user_search_indexes(engine, echo=print):
+    """Create the user search index on a users table that predates it.
+
+    On Postgres the trigram indexes are built CONCURRENTLY, like
+    `create_missing_indexes`, since every follow, like and post writes to
+    `users`.
+    """
+
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    if 'users' not in tables:
+        return
+
+    if engine.dialect.name == 'sqlite':
+        if 'users_fts' not in tables:
+            echo("Creating user search indexes")
+            with engine.begin() as connection:
+                create_user_search_index(connection)
+        return
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    names = {column: f"ix_users_{column}_trgm"
+             for column in USER_SEARCH_COLUMNS}
+
+    # CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as connection:
+        # without pg_trgm user search stays unindexed; nothing to do
+        if not connection.scalar(text(
+                "SELECT 1 FROM pg_available_extensions "
+                "WHERE name = 'pg_trgm'")):
+            return
+
+        _drop_invalid_indexes(connection, names.values(), echo)
+        existing = {index['name']
+                    for index in inspect(connection).get_indexes('users')}
+        missing = [column for column, name in names.items()
+                   if name not in existing]
+        if not missing:
+            return
+
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for column in missing:
+            echo(f"Creating index {names[column]}")
+            connection.execute(text(
+                user_search_index_ddl(column, concurrently=True)))
+
+
+@migration
+def create_missing_indexes(engine, echo=print):
+    """Create every index declared in models.py that the database lacks."""
+
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    declared = {index.name: index
+                for table in db.metadata.sorted_tables if table.name in tables
+                for index in table.indexes}
+    existing = {index['name']
+                for table in tables
+                for index in inspector.get_indexes(table)}
+
+    concurrently = engine.dialect.name == 'postgresql'
+
+    # CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as connection:
+        if concurrently:
+            _drop_invalid_indexes(connection, declared, echo)
+            existing = {index['name']
+                        for table in tables
+                        for index in inspect(connection).get_indexes(table)}
+
+        for name, index in declared.items():
+            if name in existing:
+                continue
+
+            ddl = str(CreateIndex(index, if_not_exists=True)
+                      .compile(dialect=engine.dialect))
+            if concurrently:
+                ddl = ddl.replace('INDEX', 'INDEX CONCURRENTLY', 1)
+
+            echo(f"Creating index {name}")
+            connection.execute(text(ddl))
@@ -2,13 +2,62 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, func, insert, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+import hashing
+from pagination import apply_cursor, make_page
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def adjust_counter(model, ids, counter, delta):
+    """Add `delta` to `model.counter` for one id or a SELECT of ids, in SQL."""
+
+    column = getattr(model, counter)
+
+    if isinstance(ids, int):
+        condition = model.id == ids
+    else:
+        condition = model.id.in_(ids)
+
+    (model.query
+     .filter(condition)
+     .update({column: column + delta}, synchronize_session=False))
+
+
+def dialect_insert(model):
+    """INSERT for `model` in the session's dialect, for ON CONFLICT."""
+
+    dialect = (sqlite if db.session.get_bind().dialect.name == 'sqlite'
+               else postgresql)
+    return dialect.insert(model)
+
+
+def insert_new(model, **values):
+    """INSERT one row unless its primary key exists. Returns True if added.
+
+    Runs as a single INSERT ... ON CONFLICT DO NOTHING, so it neither reads
+    the row first nor fails when a concurrent request got there first.
+    """
+
+    result = db.session.execute(
+        dialect_insert(model).values(**values).on_conflict_do_nothing())
+
+    return result.rowcount == 1
+
+
+def delete_existing(model, **values):
+    """DELETE the row matching `values`. Returns True if there was one."""
+
+    result = db.session.execute(
+        delete(model).filter_by(**values),
+        execution_options={'synchronize_session': False})
+
+    return result.rowcount == 1
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -26,28 +75,108 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key serves "who follows X"; this serves "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Record that `follower_id` follows `followed_id`.
+
+        Returns False if they already did.
+        """
+
+        return insert_new(cls, user_following_id=follower_id,
+                          user_being_followed_id=followed_id)
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Remove a follow. Returns False if there wasn't one."""
+
+        return delete_existing(cls, user_following_id=follower_id,
+                               user_being_followed_id=followed_id)
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
-
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
+    liked_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.now(),
+    )
+
+    # the primary key serves "has X liked Y"; this serves a message's likers
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Record that `user_id` likes `message_id`.
+
+        Returns False if they already did.
+        """
+
+        return insert_new(cls, user_id=user_id, message_id=message_id)
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Remove a like. Returns False if there wasn't one."""
+
+        return delete_existing(cls, user_id=user_id, message_id=message_id)
+
+    @classmethod
+    def set_liked(cls, user_id, message_id, liked):
+        """Like (or unlike) a message, updating both like counters.
+
+        Returns False, changing nothing, if it was already in that state.
+        """
+
+        changed = (cls.add(user_id, message_id) if liked
+                   else cls.remove(user_id, message_id))
+
+        if changed:
+            delta = 1 if liked else -1
+            User.adjust_counter(user_id, 'likes_count', delta)
+            Message.adjust_like_count(message_id, delta)
+
+        return changed
+
+    @classmethod
+    def liked_message_ids(cls, user_id, message_ids):
+        """Return the subset of `message_ids` that `user_id` has liked.
+
+        One query per page of messages, however many likes the user has.
+        """
+
+        if not message_ids:
+            return set()
+
+        rows = db.session.execute(
+            select(cls.message_id)
+            .where(cls.user_id == user_id)
+            .where(cls.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,43 +223,220 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts shown on profiles and the home card. Kept up to
+    # date by the write paths in app.py; `repair_counters` recomputes them.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the user deletes their account. Deactivated users are hidden
+    # everywhere until account_purge.py deletes their rows.
+    deactivated_at = db.Column(
+        db.DateTime,
+    )
+
+    # only the few deactivated users are indexed, for the purge to find
+    __table_args__ = (
+        db.Index('ix_users_deactivated_at', 'deactivated_at',
+                 postgresql_where=deactivated_at.isnot(None),
+                 sqlite_where=deactivated_at.isnot(None)),
+    )
 
+    # Rows that belong to a user are removed by the database's ON DELETE
+    # CASCADE foreign keys, so deleting a User never loads these.
+    messages = db.relationship('Message', passive_deletes=True)
+
+    # Follow and like collections can be huge, so they're never loaded
+    # whole: each is a query, and the app changes single rows with
+    # Follows.add / Follows.remove and Likes.add / Likes.remove.
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     #like will hold a list of messages objects.
     #the relation with Like table append current user id and message id
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def adjust_counter(cls, user_ids, counter, delta=1):
+        """Add `delta` to `counter` for the user(s) in `user_ids`.
+
+        `user_ids` may be a single id or a SELECT of ids. The update is done
+        in SQL so concurrent requests can't lose increments.
+        """
+
+        adjust_counter(cls, user_ids, counter, delta)
+
+    @classmethod
+    def uncount_message(cls, message):
+        """Decrement counters touched by `message` before it is deleted."""
+
+        cls.adjust_counter(message.user_id, 'messages_count', -1)
+        cls.adjust_counter(
+            select(Likes.user_id).where(Likes.message_id == message.id),
+            'likes_count', -1)
+
+    @classmethod
+    def active(cls):
+        """Query of users whose accounts aren't deactivated."""
+
+        return cls.query.filter(cls.deactivated_at.is_(None))
+
+    @classmethod
+    def deactivate(cls, user_id):
+        """Mark `user_id`'s account deactivated, hiding it until it's purged."""
+
+        (cls.query
+         .filter(cls.id == user_id)
+         .update({cls.deactivated_at: datetime.utcnow()},
+                 synchronize_session=False))
+
+    @classmethod
+    def repair_counters(cls):
+        """Recompute every user's counters from messages, follows and likes."""
+
+        def count(model, *conditions):
+            return (select(func.count())
+                    .select_from(model)
+                    .where(*conditions)
+                    .scalar_subquery())
+
+        cls.query.update({
+            cls.messages_count: count(Message, Message.user_id == cls.id),
+            cls.followers_count: count(
+                Follows, Follows.user_being_followed_id == cls.id),
+            cls.following_count: count(
+                Follows, Follows.user_following_id == cls.id),
+            cls.likes_count: count(Likes, Likes.user_id == cls.id),
+        }, synchronize_session=False)
+
+    @staticmethod
+    def start_following(follower_id, followed_id, fanout_limit,
+                        backfill_size=100):
+        """Have `follower_id` follow `followed_id`.
+
+        Updates both users' counters and backfills the follower's home
+        timeline. Returns False, changing nothing, if they already did.
+        """
+
+        if not Follows.add(follower_id, followed_id):
+            return False
+
+        User.adjust_counter(follower_id, 'following_count', 1)
+        User.adjust_counter(followed_id, 'followers_count', 1)
+        TimelineEntry.backfill(follower_id, followed_id, fanout_limit,
+                               backfill_size)
+        return True
+
+    @staticmethod
+    def stop_following(follower_id, followed_id, fanout_limit,
+                       backfill_size=100):
+        """Have `follower_id` unfollow `followed_id`.
+
+        Updates both users' counters and prunes the follower's home
+        timeline; if that takes `followed_id` back down to `fanout_limit`
+        followers, their recent messages are fanned out to the rest.
+        Returns False, changing nothing, if they didn't follow.
+        """
+
+        if not Follows.remove(follower_id, followed_id):
+            return False
+
+        User.adjust_counter(follower_id, 'following_count', -1)
+        User.adjust_counter(followed_id, 'followers_count', -1)
+        TimelineEntry.prune(follower_id, followed_id)
+        TimelineEntry.catch_up([followed_id], fanout_limit, backfill_size)
+        return True
+
+    @staticmethod
+    def follows(follower_id, followed_id):
+        """Does a follows row exist from `follower_id` to `followed_id`?"""
+
+        return db.session.scalar(
+            select(Follows.user_following_id)
+            .where(Follows.user_following_id == follower_id)
+            .where(Follows.user_being_followed_id == followed_id)
+            .exists()
+            .select())
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.follows(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return self.follows(self.id, other_user.id)
+
+    @staticmethod
+    def followed_ids_among(follower_id, user_ids):
+        """Return the subset of `user_ids` that `follower_id` follows."""
+
+        if not user_ids:
+            return set()
+
+        rows = db.session.execute(
+            select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == follower_id)
+            .where(Follows.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in rows}
+
+    def following_ids_among(self, user_ids):
+        """Return the subset of `user_ids` that this user follows.
+
+        Listing pages call this once for the page instead of calling
+        `is_following` per card.
+        """
+
+        return self.followed_ids_among(self.id, user_ids)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -139,7 +445,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hashing.generate_password_hash(password)
 
         user = User(
             username=username,
@@ -162,27 +468,17 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.verify_password(password):
+            return user
 
         return False
-    
-    @classmethod
-    def check_password(cls, username, password):
-        """Check if entered password by user matches passord stored.
 
-        This is a class method (call it on the class, not an individual user.)
-        It checks if the password entered by user whose password hash matches this password. Returns true if matches and false if it does not.
-        """
+    def verify_password(self, password):
+        """Does `password` match this user's stored hash?"""
 
-        user = cls.query.filter_by(username=username).first()
-
-        if user:
-            return bcrypt.check_password_hash(user.password, password)
+        return hashing.check_password_hash(self.password, password)
 
 
 class Message(db.Model):
@@ -203,7 +499,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -212,18 +508,351 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized number of likes, kept up to date like the User counters.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    # a user's messages, newest first, in the order cursor pagination reads
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', timestamp.desc(), id.desc()),
+    )
+
     def __repr__(self):
         return f"<Message #{self.id}: {self.text}, {self.user_id}>"
 
-    
-    def is_liked(self, user):
-        """Check if current message is in a user's liked list"""
+    @classmethod
+    def timeline_query(cls):
+        """Query messages with their authors loaded in the same SELECT.
+
+        Every timeline template reads `msg.user`; without this each row
+        lazy-loads its author separately.
+        """
+
+        return cls.query.options(db.joinedload(cls.user))
+
+    @classmethod
+    def row_query(cls, columns):
+        """Query plain rows of `columns` from messages joined to their authors.
+
+        Cheaper than `timeline_query` when the caller only needs a few
+        columns and no ORM objects. Messages by deactivated users are left
+        out.
+        """
+
+        return (db.session.query(*columns)
+                .select_from(cls)
+                .join(User, User.id == cls.user_id)
+                .filter(User.deactivated_at.is_(None)))
+
+    @classmethod
+    def adjust_like_count(cls, message_ids, delta=1):
+        """Add `delta` to `like_count` for the message(s) in `message_ids`."""
+
+        adjust_counter(cls, message_ids, 'like_count', delta)
+
+    @classmethod
+    def repair_like_counts(cls):
+        """Recompute every message's like count from likes."""
+
+        cls.query.update({
+            cls.like_count: (select(func.count())
+                             .select_from(Likes)
+                             .where(Likes.message_id == cls.id)
+                             .scalar_subquery()),
+        }, synchronize_session=False)
+
+    @classmethod
+    def latest_for(cls, user_id):
+        """Return (newest id, newest timestamp) of `user_id`'s messages."""
+
+        return db.session.execute(
+            select(func.max(cls.id), func.max(cls.timestamp))
+            .where(cls.user_id == user_id)).one()
 
-        found_liked_msg = [msg for msg in user.likes if msg == self]
-        return len(found_liked_msg) == 1
     
+    def is_liked(self, user, liked_ids=None):
+        """Check if current message is in a user's liked list.
+
+        Pass `liked_ids` (from `Likes.liked_message_ids`) when checking a
+        whole page of messages; otherwise this runs a single EXISTS query.
+        """
+
+        if liked_ids is not None:
+            return self.id in liked_ids
+
+        return db.session.scalar(
+            select(Likes.message_id)
+            .where(Likes.user_id == user.id)
+            .where(Likes.message_id == self.id)
+            .exists()
+            .select())
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
+
+    Rows are written when a message is posted (fan-out-on-write), so the home
+    feed is a single range scan on (user_id, timestamp) instead of an IN (...)
+    over every followed user. Authors with more than `fanout_limit` followers
+    are skipped on write and merged in at read time instead.
+
+    An author going over the limit needs nothing: their messages are pulled
+    from then on, and rows already written are merged away on read. One
+    coming back down has their recent messages fanned out again by
+    `catch_up`, since what they posted while over was never written.
+    Changing TIMELINE_FANOUT_LIMIT, or counters fixed by
+    `User.repair_counters`, moves authors across it without either, so
+    run `flask rebuild-timelines` afterwards.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', timestamp.desc(), message_id.desc()),
+    )
+
+    @staticmethod
+    def is_large_author(author_id, fanout_limit):
+        """Condition: does `author_id` have more than `fanout_limit` followers?
+
+        `author_id` may be a plain id or a column to correlate against.
+        """
+
+        return (select(User.id)
+                .where(User.id == author_id)
+                .where(User.followers_count > fanout_limit)
+                .exists())
+
+    @classmethod
+    def fan_out(cls, message, fanout_limit):
+        """Write `message` into its author's timeline and their followers'.
+
+        The message must already be flushed so it has an id and timestamp.
+        """
+
+        db.session.add(cls(user_id=message.user_id,
+                           message_id=message.id,
+                           timestamp=message.timestamp))
+
+        if db.session.scalar(select(
+                cls.is_large_author(message.user_id, fanout_limit))):
+            return
+
+        followers = (select(Follows.user_following_id,
+                            literal(message.id),
+                            literal(message.timestamp))
+                     .where(Follows.user_being_followed_id == message.user_id)
+                     # a self-follow row mustn't add the author's row twice
+                     .where(Follows.user_following_id != message.user_id))
+
+        db.session.execute(
+            insert(cls).from_select(['user_id', 'message_id', 'timestamp'],
+                                    followers))
+
+    @classmethod
+    def backfill(cls, user_id, author_id, fanout_limit, size=100):
+        """Copy `author_id`'s most recent messages into `user_id`'s timeline."""
+
+        # users' own messages are always in their timeline already
+        if user_id == author_id or db.session.scalar(select(
+                cls.is_large_author(author_id, fanout_limit))):
+            return
+
+        recent = (select(literal(user_id), Message.id, Message.timestamp)
+                  .where(Message.user_id == author_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(size))
+
+        db.session.execute(
+            insert(cls).from_select(['user_id', 'message_id', 'timestamp'],
+                                    recent))
+
+    @classmethod
+    def catch_up(cls, author_ids, fanout_limit, size=100):
+        """Fan out the recent messages of authors just back to the limit.
+
+        Of `author_ids`, those now at exactly `fanout_limit` followers have
+        just dropped below the pull threshold, so their `size` most recent
+        messages are copied into every follower's timeline. Rows followers
+        already have are left alone.
+        """
+
+        crossed = (select(User.id)
+                   .where(User.id.in_(author_ids))
+                   .where(User.followers_count == fanout_limit))
+
+        ranked = select(
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+            func.row_number().over(
+                partition_by=Message.user_id,
+                order_by=(Message.timestamp.desc(), Message.id.desc()),
+            ).label('position'),
+        ).where(Message.user_id.in_(crossed)).subquery()
+
+        followers = (select(Follows.user_following_id,
+                            ranked.c.id,
+                            ranked.c.timestamp)
+                     .join(ranked,
+                           ranked.c.user_id == Follows.user_being_followed_id)
+                     .where(ranked.c.position <= size)
+                     .where(Follows.user_following_id
+                            != Follows.user_being_followed_id))
+
+        db.session.execute(
+            dialect_insert(cls)
+            .from_select(['user_id', 'message_id', 'timestamp'], followers)
+            .on_conflict_do_nothing())
+
+    @classmethod
+    def prune(cls, user_id, author_id):
+        """Remove `author_id`'s messages from `user_id`'s timeline."""
+
+        if user_id == author_id:
+            return
+
+        authored = select(Message.id).where(Message.user_id == author_id)
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.message_id.in_(authored))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def messages_for(cls, user_id, fanout_limit, limit=100,
+                     before=None, after=None, columns=None):
+        """Return a `Page` of messages for `user_id`'s home feed.
+
+        Fanned-out messages come from the timeline table; messages by followed
+        authors over `fanout_limit` followers are pulled and merged here.
+        `before` / `after` are decoded (timestamp, id) cursors.
+
+        Items are `Message`s, or rows of `columns` (selected from messages
+        joined to their authors) if given; `columns` must include
+        `Message.id` and `Message.timestamp`.
+        """
+
+        def messages():
+            if columns is None:
+                return Message.timeline_query()
+            return Message.row_query(columns)
+
+        fanned = apply_cursor(
+            messages()
+            .join(cls, cls.message_id == Message.id)
+            .filter(cls.user_id == user_id),
+            cls.timestamp, cls.message_id, limit, before, after).all()
+
+        large_followed = (select(Follows.user_being_followed_id)
+                          .where(Follows.user_following_id == user_id)
+                          .where(cls.is_large_author(
+                              Follows.user_being_followed_id, fanout_limit)))
+
+        pulled = apply_cursor(
+            messages()
+            .filter(Message.user_id.in_(large_followed)),
+            Message.timestamp, Message.id, limit, before, after).all()
+
+        rows = fanned
+        if pulled:
+            merged = {msg.id: msg for msg in fanned + pulled}
+            rows = sorted(merged.values(),
+                          key=lambda msg: (msg.timestamp, msg.id),
+                          reverse=not after)
+
+        return make_page(rows, lambda msg: (msg.timestamp, msg.id),
+                         limit, before, after)
+
+    @classmethod
+    def rebuild(cls, fanout_limit, size=100):
+        """Rebuild every home timeline from `messages` and `follows`.
+
+        Each user gets their own messages plus up to `size` recent messages
+        from every followed author below `fanout_limit` followers.
+        """
+
+        cls.query.delete()
+
+        ranked = select(
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+            func.row_number().over(
+                partition_by=Message.user_id,
+                order_by=(Message.timestamp.desc(), Message.id.desc()),
+            ).label('position'),
+        ).subquery()
+
+        own = select(Message.user_id, Message.id, Message.timestamp)
+
+        followed = (select(Follows.user_following_id,
+                           ranked.c.id,
+                           ranked.c.timestamp)
+                    .join(ranked,
+                          ranked.c.user_id == Follows.user_being_followed_id)
+                    .where(ranked.c.position <= size)
+                    .where(Follows.user_following_id
+                           != Follows.user_being_followed_id)
+                    .where(~cls.is_large_author(ranked.c.user_id,
+                                                fanout_limit)))
+
+        columns = ['user_id', 'message_id', 'timestamp']
+        db.session.execute(insert(cls).from_select(columns, own))
+        db.session.execute(insert(cls).from_select(columns, followed))
+
+
+class MessageTerm(db.Model):
+    """Inverted index posting: `term` appears `weight` times in a message.
+
+    Maintained by search.index_message / search.unindex_message.
+    """
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    weight = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,156 @@
+"""Keyset (cursor) pagination for Warbler timelines and user lists.
+
+Timelines are ordered newest first on (timestamp, id). A page links to
+older rows with `?before=<cursor>` and to newer rows with `?after=<cursor>`,
+where the cursor encodes the (timestamp, id) of the row at the page edge.
+
+User lists are ordered by an id column and only page forward: the next
+page starts `?after=<id>` of the last row shown. Their pages are read
+lazily, so they can be streamed.
+
+Every page is a bounded index range scan, so page 50 costs the same as
+page 1.
+"""
+
+from datetime import datetime
+
+from flask import abort, request
+from sqlalchemy import tuple_
+
+CURSOR_SEPARATOR = '_'
+
+
+class Page:
+    """One page of rows plus the cursors for its neighbours."""
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(timestamp, row_id):
+    """Encode a (timestamp, id) position as a URL-safe token."""
+
+    return f"{timestamp.isoformat()}{CURSOR_SEPARATOR}{row_id}"
+
+
+def decode_cursor(token):
+    """Decode a token from `encode_cursor`. Raises ValueError if malformed."""
+
+    timestamp, _, row_id = token.rpartition(CURSOR_SEPARATOR)
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+
+def cursor_args():
+    """Read `before` / `after` cursors from the query string.
+
+    Aborts with 400 if either token is malformed.
+    """
+
+    try:
+        before = request.args.get('before')
+        after = request.args.get('after')
+        return (decode_cursor(before) if before else None,
+                decode_cursor(after) if after else None)
+    except ValueError:
+        abort(400)
+
+
+def apply_cursor(query, timestamp_column, id_column,
+                 limit, before=None, after=None):
+    """Filter and order `query` to one page on (timestamp, id).
+
+    Rows come back oldest first when paging with `after`, newest first
+    otherwise. One extra row is fetched so `make_page` can tell whether
+    there is another page.
+    """
+
+    position = tuple_(timestamp_column, id_column)
+
+    if after:
+        query = (query
+                 .filter(position > tuple_(*after))
+                 .order_by(timestamp_column.asc(), id_column.asc()))
+    else:
+        if before:
+            query = query.filter(position < tuple_(*before))
+        query = query.order_by(timestamp_column.desc(), id_column.desc())
+
+    return query.limit(limit + 1)
+
+
+def make_page(rows, key, limit, before=None, after=None):
+    """Build a newest-first `Page` from rows fetched by `apply_cursor`.
+
+    `key` maps a row to its (timestamp, id) position.
+    """
+
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+
+    if after:
+        rows.reverse()
+
+    if not rows:
+        return Page(rows)
+
+    older = encode_cursor(*key(rows[-1])) if has_more or after else None
+    newer = (encode_cursor(*key(rows[0]))
+             if before or (after and has_more) else None)
+
+    return Page(rows, older, newer)
+
+
+class IdPage:
+    """One page of an id-ordered list, read as it's iterated.
+
+    Takes rows fetched by `apply_id_cursor`. Iterating yields at most
+    `limit` of them; once the rows are exhausted, `next` is the cursor for
+    the following page, or None on the last page.
+    """
+
+    def __init__(self, rows, key, limit):
+        self._rows = rows
+        self._key = key
+        self.limit = limit
+        self.next = None
+
+    def __iter__(self):
+        last = None
+        for count, row in enumerate(self._rows):
+            if count == self.limit:
+                self.next = self._key(last)
+                break
+            last = row
+            yield row
+
+
+def id_cursor_arg():
+    """Read the integer `after` cursor from the query string.
+
+    Aborts with 400 if it isn't an integer.
+    """
+
+    try:
+        after = request.args.get('after')
+        return int(after) if after else None
+    except ValueError:
+        abort(400)
+
+
+def apply_id_cursor(query, id_column, limit, after=None):
+    """Filter and order `query` to the page of `id_column` values after
+    `after`, fetching one extra row to tell whether there is another page.
+    """
+
+    if after is not None:
+        query = query.where(id_column > after)
+
+    return query.order_by(id_column).limit(limit + 1)
@@ -0,0 +1,75 @@
+"""Read-only row types for Warbler's list and timeline pages.
+
+List pages only print a few fields per row, so they select just those
+columns and wrap each row in a named tuple instead of loading `User` /
+`Message` instances. Tuples skip the identity map, change tracking and
+relationship loading, and cost one small allocation per row.
+
+Each type's fields line up with its `COLUMNS`, so rows from a select of
+those columns convert with `from_rows`.
+"""
+
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from sqlalchemy import select
+
+from models import User, Message
+
+
+class UserCard(NamedTuple):
+    """The fields a user card shows."""
+
+    id: int
+    username: str
+    image_url: Optional[str]
+    header_image_url: Optional[str]
+    bio: Optional[str]
+
+    @classmethod
+    def select(cls):
+        """select() of user card columns for users who aren't deactivated."""
+
+        return (select(*USER_CARD_COLUMNS)
+                .where(User.deactivated_at.is_(None)))
+
+    @classmethod
+    def from_rows(cls, rows):
+        return [cls._make(row) for row in rows]
+
+
+class TimelineItem(NamedTuple):
+    """A message in a timeline, with the author fields it's shown with."""
+
+    id: int
+    text: str
+    timestamp: datetime
+    like_count: int
+    user_id: int
+    username: str
+    user_image_url: Optional[str]
+
+    @classmethod
+    def query(cls):
+        """Query of timeline item rows: messages joined to their authors."""
+
+        return Message.row_query(TIMELINE_ITEM_COLUMNS)
+
+    @classmethod
+    def from_rows(cls, rows):
+        return [cls._make(row) for row in rows]
+
+
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+TIMELINE_ITEM_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                         Message.like_count, Message.user_id, User.username,
+                         User.image_url.label('user_image_url'))
+
+
+def timeline_page(page):
+    """Convert a `Page` of timeline item rows to `TimelineItem`s in place."""
+
+    page.items = TimelineItem.from_rows(page.items)
+    return page
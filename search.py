@@ -0,0 +1,264 @@
+"""Indexed search for Warbler.
+
+User search matches substrings of usernames, bios and locations. On
+Postgres the match is served by pg_trgm GIN indexes, which turn
+ILIKE '%q%' into an index lookup instead of a scan of `users`. On SQLite
+an FTS5 table with the trigram tokenizer plays the same role.
+
+Message search uses an inverted index (`message_terms`) of term -> message
+postings, updated as messages are added and deleted. A query only reads
+the postings for its own terms, so its cost doesn't depend on how many
+messages exist.
+"""
+
+import logging
+import math
+import re
+from collections import Counter
+
+from sqlalchemy import case, event, func, insert, or_, select, text
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User, Message, MessageTerm
+from read_models import UserCard
+
+logger = logging.getLogger(__name__)
+
+USER_SEARCH_COLUMNS = ('username', 'bio', 'location')
+
+TERM_PATTERN = re.compile(r"[\w']+")
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have i if in is it its of on
+    or so that the this to was we were will with you
+""".split())
+MAX_QUERY_TERMS = 8
+INDEX_BATCH_SIZE = 5000
+
+# FTS5's trigram tokenizer can't match queries shorter than one trigram.
+MIN_FTS_QUERY_LENGTH = 3
+
+
+##############################################################################
+# Index setup
+
+
+def user_search_index_ddl(column, concurrently=False):
+    """CREATE INDEX for the Postgres trigram index on users.`column`."""
+
+    return (f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}"
+            f"IF NOT EXISTS ix_users_{column}_trgm "
+            f"ON users USING gin ({column} gin_trgm_ops)")
+
+
+def create_user_search_index(connection):
+    """Create the user search index for this connection's database.
+
+    Safe to run repeatedly. If pg_trgm isn't installed on the server,
+    search still works but falls back to scanning `users`.
+    """
+
+    if connection.dialect.name == 'postgresql':
+        try:
+            with connection.begin_nested():
+                connection.execute(
+                    text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                for column in USER_SEARCH_COLUMNS:
+                    connection.execute(text(user_search_index_ddl(column)))
+        except DBAPIError as error:
+            logger.warning("pg_trgm unavailable, user search is unindexed: %s",
+                           error.orig)
+
+    elif connection.dialect.name == 'sqlite':
+        columns = ', '.join(USER_SEARCH_COLUMNS)
+        new_values = ', '.join(f"new.{column}" for column in USER_SEARCH_COLUMNS)
+        old_values = ', '.join(f"old.{column}" for column in USER_SEARCH_COLUMNS)
+
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+            f"{columns}, content='users', content_rowid='id', "
+            f"tokenize='trigram')"))
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS users_fts_insert "
+            f"AFTER INSERT ON users BEGIN "
+            f"INSERT INTO users_fts(rowid, {columns}) "
+            f"VALUES (new.id, {new_values}); END"))
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS users_fts_delete "
+            f"AFTER DELETE ON users BEGIN "
+            f"INSERT INTO users_fts(users_fts, rowid, {columns}) "
+            f"VALUES ('delete', old.id, {old_values}); END"))
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS users_fts_update "
+            f"AFTER UPDATE ON users BEGIN "
+            f"INSERT INTO users_fts(users_fts, rowid, {columns}) "
+            f"VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO users_fts(rowid, {columns}) "
+            f"VALUES (new.id, {new_values}); END"))
+        connection.execute(text(
+            "INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+
+
+def drop_user_search_index(connection):
+    """Drop search structures that `drop_all` doesn't know about."""
+
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("DROP TABLE IF EXISTS users_fts"))
+
+
+event.listen(User.__table__, 'after_create',
+             lambda target, connection, **kw:
+             create_user_search_index(connection))
+event.listen(User.__table__, 'before_drop',
+             lambda target, connection, **kw:
+             drop_user_search_index(connection))
+
+
+##############################################################################
+# Queries
+
+
+def search_users(query, limit=50):
+    """Return up to `limit` `UserCard`s matching `query`, best matches first.
+
+    Exact username matches rank first, then username prefixes, then other
+    username substrings, then bio / location matches.
+    """
+
+    if (db.engine.dialect.name == 'sqlite'
+            and len(query) >= MIN_FTS_QUERY_LENGTH):
+        return _search_users_fts(query, limit)
+
+    username = User.username
+    rank = case(
+        (func.lower(username) == query.lower(), 0),
+        (username.istartswith(query, autoescape=True), 1),
+        (username.icontains(query, autoescape=True), 2),
+        else_=3,
+    )
+    matches = or_(*(getattr(User, column).icontains(query, autoescape=True)
+                    for column in USER_SEARCH_COLUMNS))
+
+    return UserCard.from_rows(db.session.execute(
+        UserCard.select()
+        .where(matches)
+        .order_by(rank, func.length(username), User.id)
+        .limit(limit)))
+
+
+def _search_users_fts(query, limit):
+    """Search the SQLite FTS5 table, ranked by bm25 with username weighted."""
+
+    phrase = '"{}"'.format(query.replace('"', '""'))
+    rows = db.session.execute(
+        text("SELECT rowid FROM users_fts WHERE users_fts MATCH :phrase "
+             "ORDER BY bm25(users_fts, 10.0, 1.0, 1.0) LIMIT :limit"),
+        {'phrase': phrase, 'limit': limit})
+    ids = [user_id for (user_id,) in rows]
+
+    users = {user.id: user for user in UserCard.from_rows(
+        db.session.execute(UserCard.select().where(User.id.in_(ids))))}
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+##############################################################################
+# Message index
+
+
+def tokenize(body):
+    """Split `body` into lowercased index terms, dropping stop words."""
+
+    terms = (term.strip("'").lower() for term in TERM_PATTERN.findall(body))
+    return [term for term in terms if len(term) > 1 and term not in STOP_WORDS]
+
+
+def _postings(message_id, body):
+    return [{'term': term, 'message_id': message_id, 'weight': weight}
+            for term, weight in Counter(tokenize(body)).items()]
+
+
+def index_message(message):
+    """Add postings for a new (flushed) message."""
+
+    postings = _postings(message.id, message.text)
+
+    if postings:
+        db.session.execute(insert(MessageTerm), postings)
+
+
+def unindex_message(message):
+    """Remove a message's postings (they also cascade on delete)."""
+
+    MessageTerm.query.filter_by(message_id=message.id).delete()
+
+
+def rebuild_message_index(batch_size=INDEX_BATCH_SIZE):
+    """Rebuild the whole message index from `messages`, `batch_size` at a time."""
+
+    MessageTerm.query.delete()
+    last_id = 0
+
+    while True:
+        batch = db.session.execute(
+            select(Message.id, Message.text)
+            .where(Message.id > last_id)
+            .order_by(Message.id)
+            .limit(batch_size)).all()
+
+        if not batch:
+            break
+
+        postings = [posting for message_id, body in batch
+                    for posting in _postings(message_id, body)]
+        if postings:
+            db.session.execute(insert(MessageTerm), postings)
+
+        last_id = batch[-1].id
+
+
+def search_messages(query, page=1, per_page=20):
+    """Return (messages, has_next) for one page of ranked message results.
+
+    Messages matching more of the query terms rank first, then by tf-idf.
+    Messages by deactivated users are left out.
+    """
+
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return [], False
+
+    frequencies = dict(db.session.execute(
+        select(MessageTerm.term, func.count())
+        .where(MessageTerm.term.in_(terms))
+        .group_by(MessageTerm.term)).all())
+    if not frequencies:
+        return [], False
+
+    # highest id is an index-only stand-in for the number of messages
+    corpus_size = db.session.scalar(select(func.max(Message.id))) or 1
+    idf = case(
+        {term: math.log(1 + corpus_size / count)
+         for term, count in frequencies.items()},
+        value=MessageTerm.term,
+        else_=0.0,
+    )
+
+    ranked = db.session.execute(
+        select(MessageTerm.message_id)
+        .join(Message, Message.id == MessageTerm.message_id)
+        .join(User, User.id == Message.user_id)
+        .where(MessageTerm.term.in_(list(frequencies)))
+        .where(User.deactivated_at.is_(None))
+        .group_by(MessageTerm.message_id)
+        .order_by(func.count().desc(),
+                  func.sum(MessageTerm.weight * idf).desc(),
+                  MessageTerm.message_id.desc())
+        .offset((page - 1) * per_page)
+        .limit(per_page + 1))
+    ids = [message_id for (message_id,) in ranked]
+
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+
+    messages = {msg.id: msg for msg in
+                Message.timeline_query().filter(Message.id.in_(ids))}
+    return [messages[message_id] for message_id in ids], has_next
@@ -1,27 +1,184 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Each CSV is streamed into its table in fixed-size chunks, so memory use
+stays flat no matter how big the files are. On Postgres every chunk goes
+through COPY FROM STDIN; elsewhere it's a batched executemany. Foreign
+keys, unique constraints and secondary indexes are dropped before the
+load and rebuilt once at the end, which is much cheaper than maintaining
+them row by row.
+
+run it like:
+
+    python seed.py [--data-dir generator] [--chunk-size 50000]
+"""
+
+import argparse
+import csv
+import io
+import time
+
+from sqlalchemy import text
 
-from csv import DictReader
 from app import db, app
-from models import User, Message, Follows
+from models import User, Message, Follows, TimelineEntry
+from search import rebuild_message_index
 
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+# load order matters: messages and follows reference users
+CSV_TABLES = (
+    ('users.csv', User.__table__),
+    ('messages.csv', Message.__table__),
+    ('follows.csv', Follows.__table__),
+)
 
-with open('generator/users.csv') as users:
-    with app.app_context():
-        db.session.bulk_insert_mappings(User, DictReader(users))
-        db.session.commit()
+DEFAULT_CHUNK_SIZE = 50000
 
-with open('generator/messages.csv') as messages:
-    with app.app_context():
-        db.session.bulk_insert_mappings(Message, DictReader(messages))
-        db.session.commit()
 
-with open('generator/follows.csv') as follows:
+def read_chunks(csv_file, chunk_size):
+    """Yield (header, rows) for successive chunks of at most `chunk_size` rows."""
+
+    reader = csv.reader(csv_file)
+    header = next(reader)
+    chunk = []
+
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield header, chunk
+            chunk = []
+
+    if chunk:
+        yield header, chunk
+
+
+def copy_chunk(connection, table, header, rows):
+    """Load one chunk with Postgres COPY FROM STDIN."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    columns = ', '.join(header)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_chunk(connection, table, header, rows):
+    """Load one chunk with a single executemany INSERT."""
+
+    columns = ', '.join(header)
+    placeholders = ', '.join('?' for _ in header)
+    connection.exec_driver_sql(
+        f"INSERT INTO {table.name} ({columns}) VALUES ({placeholders})",
+        [tuple(value or None for value in row) for row in rows])
+
+
+def drop_constraints(connection, tables):
+    """Drop FKs, unique constraints and secondary indexes on `tables`.
+
+    Returns the DDL needed to put them back, in a safe order.
+    """
+
+    names = [table.name for table in tables]
+
+    constraints = connection.execute(text(
+        "SELECT conrelid::regclass::text, conname, contype, "
+        "pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid::regclass::text = ANY(:names) "
+        "AND contype IN ('f', 'u') "
+        "ORDER BY contype = 'u'"), {'names': names}).all()
+
+    indexes = connection.execute(text(
+        "SELECT indexname, indexdef FROM pg_indexes "
+        "WHERE schemaname = current_schema() AND tablename = ANY(:names) "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint)"),
+        {'names': names}).all()
+
+    for table, name, _, _ in constraints:
+        connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+    for name, _ in indexes:
+        connection.execute(text(f'DROP INDEX "{name}"'))
+
+    restore = [definition for _, definition in indexes]
+    restore += [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+                for table, name, kind, definition in constraints if kind == 'u']
+    restore += [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+                for table, name, kind, definition in constraints if kind == 'f']
+    return restore
+
+
+def reset_sequences(connection, tables):
+    """Point serial id sequences past the highest loaded id."""
+
+    for table in tables:
+        if 'id' not in table.c:
+            continue
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table.name}"))
+
+
+def load_csv(connection, path, table, chunk_size):
+    """Stream `path` into `table`; return the number of rows loaded."""
+
+    load_chunk = (copy_chunk if connection.dialect.name == 'postgresql'
+                  else insert_chunk)
+    loaded = 0
+    start = time.perf_counter()
+
+    with open(path, newline='') as csv_file:
+        for header, rows in read_chunks(csv_file, chunk_size):
+            load_chunk(connection, table, header, rows)
+            loaded += len(rows)
+            print(f"  {table.name}: {loaded:,} rows", end='\r', flush=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"  {table.name}: {loaded:,} rows in {elapsed:.2f}s "
+          f"({loaded / max(elapsed, 1e-9):,.0f} rows/sec)")
+    return loaded
+
+
+def seed(data_dir='generator', chunk_size=DEFAULT_CHUNK_SIZE):
     with app.app_context():
-        db.session.bulk_insert_mappings(Follows, DictReader(follows))
+        db.drop_all()
+        db.create_all()
+
+        tables = [table for _, table in CSV_TABLES]
+        is_postgres = db.engine.dialect.name == 'postgresql'
+
+        with db.engine.begin() as connection:
+            restore = drop_constraints(connection, tables) if is_postgres else []
+
+            for filename, table in CSV_TABLES:
+                load_csv(connection, f"{data_dir}/{filename}", table,
+                         chunk_size)
+
+            start = time.perf_counter()
+            if is_postgres:
+                reset_sequences(connection, tables)
+            for statement in restore:
+                connection.execute(text(statement))
+            print(f"  rebuilt constraints and indexes in "
+                  f"{time.perf_counter() - start:.2f}s")
+
+        if is_postgres:
+            with db.engine.connect() as connection:
+                connection.execute(text("ANALYZE"))
+
+        start = time.perf_counter()
+        User.repair_counters()
+        TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_LIMIT'],
+                              app.config['TIMELINE_BACKFILL_SIZE'])
+        rebuild_message_index()
         db.session.commit()
+        print(f"  rebuilt counters, timelines and search index in "
+              f"{time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Seed Warbler from CSVs.")
+    parser.add_argument('--data-dir', default='generator')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
 
-# with app.app_context():
-#     db.session.commit()
+    seed(args.data_dir, args.chunk_size)
@@ -0,0 +1,246 @@
+"""Slow query log with EXPLAIN plans.
+
+Opt-in: set SLOW_QUERY_THRESHOLD_MS to log every statement that takes at
+least that long, along with its parameters and the route that ran it. The
+recorder listens through `metrics.on_query`, so it sees the same timings
+as /metrics.
+
+The request thread only queues the statement. A background thread,
+started by the first slow statement in each process, asks
+Postgres for the plan and writes one JSON object per line to
+SLOW_QUERY_LOG (rotated at SLOW_QUERY_LOG_MAX_BYTES). SELECTs get
+EXPLAIN (ANALYZE, BUFFERS), which runs the query again inside a
+rolled-back transaction with a statement timeout; anything else only gets
+a plain EXPLAIN, so writes are never repeated. Other databases are logged
+without a plan.
+
+Parameters are logged as-is, so turn this on deliberately.
+
+`flask slow-queries` summarizes the log by total time per statement.
+"""
+
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy.exc import DBAPIError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 1000
+MAX_PARAMETER_LENGTH = 200
+EXPLAIN_TIMEOUT_MS = 10000
+
+
+class SlowQueryRecorder:
+    """Queue statements over the threshold; explain and log them off-thread."""
+
+    def __init__(self, engine, threshold_ms, path, explain=True,
+                 max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.engine = engine
+        self.threshold = threshold_ms / 1000
+        self.explain = explain and engine.dialect.name == 'postgresql'
+        self.dropped = 0
+
+        self.log = logging.getLogger(f"{__name__}.{path}")
+        self.log.setLevel(logging.INFO)
+        self.log.propagate = False
+        # opened by the first write, in the process that writes
+        self.handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                           backupCount=backup_count,
+                                           delay=True)
+        self.log.addHandler(self.handler)
+
+        # The worker thread starts with the first slow statement in each
+        # process: a pre-forking server's workers inherit this object but
+        # not the thread, so importing the app mustn't start it.
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._worker = None
+
+    def _running_queue(self):
+        """This process's queue, with its worker thread started."""
+
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(QUEUE_SIZE)
+                    self._worker = threading.Thread(
+                        target=self._work, args=(self._queue,), daemon=True,
+                        name='slow-query-log')
+                    self._worker.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def record(self, conn, statement, parameters, duration):
+        if duration < self.threshold:
+            return
+        if not conn.get_execution_options().get('slow_query_log', True):
+            return
+
+        entry = dict(
+            logged_at=datetime.now(timezone.utc).isoformat(),
+            duration_ms=round(duration * 1000, 3),
+            statement=statement,
+            parameters=_loggable(parameters),
+            endpoint=request.endpoint if has_request_context() else None,
+            path=request.path if has_request_context() else None,
+        )
+
+        try:
+            self._running_queue().put_nowait((entry, parameters))
+        except queue.Full:
+            self.dropped += 1
+
+    def _work(self, items):
+        while True:
+            item = items.get()
+            try:
+                if item is None:
+                    return
+                entry, parameters = item
+                if self.explain:
+                    entry['plan'] = self._explain(entry['statement'],
+                                                  parameters)
+                self.log.info(json.dumps(entry, default=str))
+            except Exception:
+                logger.exception("Couldn't log slow query")
+            finally:
+                items.task_done()
+
+    def _explain(self, statement, parameters):
+        # executemany parameter lists can't be explained as one statement
+        if isinstance(parameters, list):
+            return None
+
+        analyze = statement.lstrip().upper().startswith('SELECT')
+        options = ('ANALYZE, BUFFERS, FORMAT JSON' if analyze
+                   else 'FORMAT JSON')
+
+        try:
+            with self.engine.connect() as conn:
+                conn = conn.execution_options(slow_query_log=False)
+                with conn.begin() as transaction:
+                    conn.exec_driver_sql(
+                        f"SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}")
+                    plan = conn.exec_driver_sql(
+                        f"EXPLAIN ({options}) {statement}",
+                        parameters or ()).scalar()
+                    transaction.rollback()
+            return plan
+        except DBAPIError as error:
+            return {'error': str(error.orig).strip()}
+
+    def flush(self):
+        """Wait until everything queued so far is written."""
+
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._worker.join()
+        self.log.removeHandler(self.handler)
+        self.handler.close()
+
+
+def _loggable(parameters):
+    """Parameters as JSON-friendly values, long ones truncated."""
+
+    def shorten(value):
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        value = str(value)
+        if len(value) > MAX_PARAMETER_LENGTH:
+            return value[:MAX_PARAMETER_LENGTH] + '...'
+        return value
+
+    if isinstance(parameters, dict):
+        return {key: shorten(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_loggable(value) if isinstance(value, (dict, list, tuple))
+                else shorten(value) for value in parameters]
+    return shorten(parameters)
+
+
+recorder = None
+
+
+def _record(conn, statement, parameters, duration):
+    if recorder is not None:
+        recorder.record(conn, statement, parameters, duration)
+
+
+metrics.on_query(_record)
+
+
+def start(engine, threshold_ms, path, **options):
+    """Start logging statements slower than `threshold_ms` to `path`."""
+
+    global recorder
+
+    stop()
+    recorder = SlowQueryRecorder(engine, threshold_ms, path, **options)
+    return recorder
+
+
+def stop():
+    """Stop logging, after writing out anything already queued."""
+
+    global recorder
+
+    if recorder is not None:
+        current, recorder = recorder, None
+        current.close()
+
+
+def init_app(app, engine):
+    """Start the recorder if SLOW_QUERY_THRESHOLD_MS is set."""
+
+    config = app.config
+    if config['SLOW_QUERY_THRESHOLD_MS'] is None:
+        return
+
+    start(engine, config['SLOW_QUERY_THRESHOLD_MS'], config['SLOW_QUERY_LOG'],
+          explain=config['SLOW_QUERY_EXPLAIN'],
+          max_bytes=config['SLOW_QUERY_LOG_MAX_BYTES'],
+          backup_count=config['SLOW_QUERY_LOG_BACKUP_COUNT'])
+
+
+def summarize(path, top=10):
+    """Aggregate a slow query log (and its rotated files) by statement.
+
+    Returns up to `top` dicts, most total time first.
+    """
+
+    totals = {}
+
+    for log_path in [path] + sorted(glob.glob(f"{glob.escape(path)}.*")):
+        with open(log_path) as log_file:
+            for line in log_file:
+                entry = json.loads(line)
+                stats = totals.setdefault(entry['statement'], dict(
+                    statement=entry['statement'], count=0, total_ms=0.0,
+                    max_ms=0.0, endpoints=set()))
+                stats['count'] += 1
+                stats['total_ms'] += entry['duration_ms']
+                stats['max_ms'] = max(stats['max_ms'], entry['duration_ms'])
+                if entry.get('endpoint'):
+                    stats['endpoints'].add(entry['endpoint'])
+
+    ranked = sorted(totals.values(), key=lambda stats: stats['total_ms'],
+                    reverse=True)[:top]
+    for stats in ranked:
+        stats['mean_ms'] = stats['total_ms'] / stats['count']
+        stats['endpoints'] = sorted(stats['endpoints'])
+    return ranked
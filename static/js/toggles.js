@@ -0,0 +1,92 @@
+/* Like and follow buttons without a page reload.
+ *
+ * Like and follow forms still post normally. When they carry
+ * data-enhance="like" or data-enhance="follow", this sends the change to the
+ * JSON API instead: POST at data-api turns it on and DELETE turns it off,
+ * depending on data-active. The response's state and counts then update
+ * the button and any element marked with the matching data-*-count
+ * attribute. If the request fails, the form is submitted the old way.
+ */
+(function () {
+  'use strict';
+
+  var ACTIVE_CLASSES = {
+    like: ['btn-primary', 'btn-secondary'],
+    follow: ['btn-primary', 'btn-outline-primary'],
+  };
+
+  function setCounts(name, id, value) {
+    var selector = '[data-' + name + '="' + id + '"]';
+    document.querySelectorAll(selector).forEach(function (element) {
+      element.textContent = value;
+    });
+  }
+
+  function setActive(form, kind, active) {
+    var button = form.querySelector('button');
+    var classes = ACTIVE_CLASSES[kind];
+
+    form.dataset.active = active ? 'true' : 'false';
+    button.classList.toggle(classes[0], active);
+    button.classList.toggle(classes[1], !active);
+
+    // the fallback post for the next click
+    var action = active ? form.dataset.activeAction : form.dataset.inactiveAction;
+    if (action) {
+      form.action = action;
+    }
+    if (kind === 'follow') {
+      button.textContent = active ? 'Unfollow' : 'Follow';
+    }
+  }
+
+  function update(kind, api, data) {
+    var active = kind === 'like' ? data.liked : data.following;
+    var selector = 'form[data-api="' + api + '"]';
+
+    document.querySelectorAll(selector).forEach(function (form) {
+      setActive(form, kind, active);
+    });
+
+    if (kind === 'like') {
+      setCounts('like-count', data.message_id, data.like_count);
+      setCounts('likes-count', data.user_id, data.likes_count);
+    } else {
+      setCounts('followers-count', data.user_id, data.followers_count);
+      setCounts('following-count', data.follower_id, data.following_count);
+    }
+  }
+
+  document.addEventListener('submit', function (event) {
+    var form = event.target;
+    var kind = form.dataset.enhance;
+
+    if (!ACTIVE_CLASSES[kind] || !window.fetch) {
+      return;
+    }
+    event.preventDefault();
+
+    var button = form.querySelector('button');
+    button.disabled = true;
+
+    fetch(form.dataset.api, {
+      method: form.dataset.active === 'true' ? 'DELETE' : 'POST',
+      credentials: 'same-origin',
+      headers: {Accept: 'application/json'},
+    })
+      .then(function (response) {
+        if (!response.ok) {
+          throw new Error(response.status);
+        }
+        return response.json();
+      })
+      .then(function (body) {
+        update(kind, form.dataset.api, body.data);
+        button.disabled = false;
+      })
+      .catch(function () {
+        // HTMLFormElement.submit() skips this handler
+        form.submit();
+      });
+  });
+})();
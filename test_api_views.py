@@ -0,0 +1,230 @@
+"""JSON API view tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api_views.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+# Cheapest bcrypt cost keeps signup-heavy setUp fast
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+# This is a bit of hack, but don't use Flask DebugToolbar
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+
+
+class APIViewTestCase(TestCase):
+    """Test views under /api/v1/."""
+
+    def setUp(self):
+        """Create two users, a follow, three messages and a like."""
+        with app.app_context():
+            User.query.delete()
+            Message.query.delete()
+            Follows.query.delete()
+            Likes.query.delete()
+
+            author = User.signup("author", "author@test.com", "password", None)
+            reader = User.signup("reader", "reader@test.com", "password", None)
+            db.session.commit()
+
+            db.session.add(Follows(user_being_followed_id=author.id,
+                                   user_following_id=reader.id))
+
+            start = datetime(2024, 1, 1)
+            messages = [Message(text=f"Warble {i}", user_id=author.id,
+                                timestamp=start + timedelta(minutes=i))
+                        for i in range(3)]
+            db.session.add_all(messages)
+            db.session.flush()
+            db.session.add(Likes(user_id=reader.id, message_id=messages[0].id))
+
+            User.repair_counters()
+            Message.repair_like_counts()
+            TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_LIMIT'])
+            db.session.commit()
+
+            self.author_id = author.id
+            self.reader_id = reader.id
+            self.message_ids = [message.id for message in messages]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+        with app.app_context():
+            db.session.rollback()
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_timeline_pages(self):
+        """The timeline pages newest first and marks the viewer's likes"""
+        with self.client as c:
+            self.login(c, self.reader_id)
+
+            resp = c.get("/api/v1/timeline?limit=2")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, "application/json")
+
+            body = resp.get_json()
+            self.assertEqual([msg['text'] for msg in body['data']],
+                             ["Warble 2", "Warble 1"])
+            self.assertEqual(body['data'][0]['username'], "author")
+            self.assertEqual(body['data'][0]['timestamp'],
+                             "2024-01-01T00:02:00")
+            self.assertIsNone(body['newer'])
+
+            body = c.get(body['older']).get_json()
+            self.assertEqual(body['data'], [{
+                'id': self.message_ids[0],
+                'text': "Warble 0",
+                'timestamp': "2024-01-01T00:00:00",
+                'like_count': 1,
+                'user_id': self.author_id,
+                'username': "author",
+                'user_image_url': "/static/images/default-pic.png",
+                'liked': True,
+            }])
+            self.assertIsNone(body['older'])
+
+    def test_field_selection(self):
+        """?fields= limits the response to the named fields"""
+        with self.client as c:
+            resp = c.get(f"/api/v1/users/{self.author_id}/messages"
+                         f"?fields=text,like_count&limit=1")
+            self.assertEqual(resp.get_json()['data'],
+                             [{'text': "Warble 2", 'like_count': 0}])
+            self.assertIn("fields=text", resp.get_json()['older'])
+
+            # query args can't clash with the view's or url_for's arguments
+            resp = c.get(f"/api/v1/users/{self.author_id}/messages"
+                         f"?limit=1&user_id=0&_external=1")
+            self.assertEqual(resp.status_code, 200)
+            older = resp.get_json()['older']
+            self.assertTrue(older.startswith(
+                f"/api/v1/users/{self.author_id}/messages?"))
+            self.assertNotIn("user_id", older)
+
+            resp = c.get(f"/api/v1/users/{self.author_id}?fields=username")
+            self.assertEqual(resp.get_json(), {'data': {'username': "author"}})
+
+            resp = c.get(f"/api/v1/users/{self.author_id}?fields=password")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("Unknown fields: password", resp.get_json()['error'])
+
+    def test_followers_following_and_likes(self):
+        with self.client as c:
+            resp = c.get(f"/api/v1/users/{self.author_id}/followers")
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn('error', resp.get_json())
+
+            self.login(c, self.reader_id)
+
+            body = c.get(f"/api/v1/users/{self.author_id}/followers").get_json()
+            self.assertEqual([user['username'] for user in body['data']],
+                             ["reader"])
+            self.assertIsNone(body['next'])
+
+            body = c.get(f"/api/v1/users/{self.reader_id}/following").get_json()
+            self.assertEqual([user['id'] for user in body['data']],
+                             [self.author_id])
+
+            resp = c.get(f"/api/v1/users/{self.author_id}/followers?after=abc")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('error', resp.get_json())
+
+            body = c.get(f"/api/v1/users/{self.reader_id}/likes").get_json()
+            self.assertEqual([msg['id'] for msg in body['data']],
+                             [self.message_ids[0]])
+
+    def test_message_detail(self):
+        with self.client as c:
+            resp = c.get(f"/api/v1/messages/{self.message_ids[1]}")
+            self.assertEqual(resp.get_json()['data']['text'], "Warble 1")
+            self.assertIsNone(resp.get_json()['data']['liked'])
+
+            resp = c.get("/api/v1/messages/0")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.get_json(), {'error': "No such message."})
+
+    def test_like_and_unlike(self):
+        with self.client as c:
+            resp = c.post(f"/api/v1/messages/{self.message_ids[1]}/like")
+            self.assertEqual(resp.status_code, 401)
+
+            self.login(c, self.reader_id)
+
+            resp = c.post(f"/api/v1/messages/{self.message_ids[1]}/like")
+            self.assertEqual(resp.get_json(), {'data': {
+                'message_id': self.message_ids[1],
+                'liked': True,
+                'like_count': 1,
+                'user_id': self.reader_id,
+                'likes_count': 2,
+            }})
+
+            # liking again changes nothing
+            resp = c.post(f"/api/v1/messages/{self.message_ids[1]}/like")
+            self.assertEqual(resp.get_json()['data']['like_count'], 1)
+
+            resp = c.delete(f"/api/v1/messages/{self.message_ids[0]}/like")
+            body = resp.get_json()['data']
+            self.assertFalse(body['liked'])
+            self.assertEqual((body['like_count'], body['likes_count']), (0, 1))
+
+            self.login(c, self.author_id)
+            resp = c.post(f"/api/v1/messages/{self.message_ids[1]}/like")
+            self.assertEqual(resp.status_code, 403)
+
+    def test_follow_and_unfollow(self):
+        with self.client as c:
+            self.login(c, self.author_id)
+
+            resp = c.post(f"/api/v1/users/{self.reader_id}/follow")
+            self.assertEqual(resp.get_json(), {'data': {
+                'user_id': self.reader_id,
+                'following': True,
+                'followers_count': 1,
+                'follower_id': self.author_id,
+                'following_count': 1,
+            }})
+
+            self.login(c, self.reader_id)
+            resp = c.delete(f"/api/v1/users/{self.author_id}/follow")
+            body = resp.get_json()['data']
+            self.assertFalse(body['following'])
+            self.assertEqual((body['followers_count'], body['following_count']),
+                             (0, 0))
+
+            resp = c.post("/api/v1/users/0/follow")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.post(f"/api/v1/users/{self.reader_id}/follow")
+            self.assertEqual(resp.status_code, 403)
+
+        with app.app_context():
+            self.assertFalse(User.follows(self.reader_id, self.author_id))
+            self.assertTrue(User.follows(self.author_id, self.reader_id))
@@ -7,8 +7,11 @@
 
 import os
 from unittest import TestCase
-from sqlalchemy import exc
-from models import db, User, Message, Follows, Likes
+from sqlalchemy import exc, inspect, text
+
+import migrations
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from search import search_messages
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -24,6 +27,8 @@ from app import app
 # app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler-test'
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['TESTING'] = True
+# Cheapest bcrypt cost keeps signup-heavy setUp fast
+app.config['BCRYPT_LOG_ROUNDS'] = 4
 
 # This is a bit of hack, but don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
@@ -100,4 +105,147 @@ class MessageModelTestCase(TestCase):
             db.session.commit()
             
             self.assertTrue(message.is_liked(user2))
-            self.assertFalse(message.is_liked(user1))
\ No newline at end of file
+            self.assertFalse(message.is_liked(user1))
+
+    def test_liked_message_ids(self):
+        """liked_message_ids returns only the liked ids from the given page"""
+
+        with app.app_context():
+            liked = Message(text="Liked", user_id=self.user1_id)
+            other = Message(text="Not liked", user_id=self.user1_id)
+            db.session.add_all([liked, other])
+            db.session.commit()
+
+            db.session.add(Likes(user_id=self.user2_id, message_id=liked.id))
+            db.session.commit()
+
+            liked_ids = Likes.liked_message_ids(self.user2_id,
+                                                [liked.id, other.id])
+            self.assertEqual(liked_ids, {liked.id})
+
+            user2 = db.session.get(User, self.user2_id)
+            self.assertTrue(liked.is_liked(user2, liked_ids))
+            self.assertFalse(other.is_liked(user2, liked_ids))
+            self.assertEqual(Likes.liked_message_ids(self.user2_id, []), set())
+
+    def test_migrate_creates_missing_indexes(self):
+        """Migrating adds declared indexes back without touching rows"""
+
+        with app.app_context():
+            db.session.add(Message(text="Keep me", user_id=self.user1_id))
+            db.session.commit()
+            db.session.close()
+
+            with db.engine.begin() as connection:
+                connection.execute(
+                    text("DROP INDEX ix_messages_user_id_timestamp"))
+
+            logged = []
+            migrations.run(db.engine, echo=logged.append)
+            self.assertEqual(logged,
+                             ["Creating index ix_messages_user_id_timestamp"])
+
+            indexes = {index['name']: index['column_names'] for index in
+                       inspect(db.engine).get_indexes('messages')}
+            self.assertEqual(indexes['ix_messages_user_id_timestamp'],
+                             ['user_id', 'timestamp', 'id'])
+            self.assertEqual(Message.query.filter_by(text="Keep me").count(), 1)
+
+            logged.clear()
+            migrations.run(db.engine, echo=logged.append)
+            self.assertEqual(logged, [])
+
+    def test_migrate_legacy_likes(self):
+        """Old likes tables are rekeyed and counted without losing likes"""
+
+        with app.app_context():
+            message = Message(text="Popular", user_id=self.user1_id)
+            db.session.add(message)
+            db.session.commit()
+            message_id = message.id
+            db.session.close()
+
+            # likes as they were before the composite key and like counts
+            with db.engine.begin() as connection:
+                connection.execute(text("DROP TABLE likes"))
+                connection.execute(text(
+                    "CREATE TABLE likes ("
+                    "id SERIAL PRIMARY KEY, "
+                    "user_id INTEGER REFERENCES users ON DELETE CASCADE, "
+                    "message_id INTEGER UNIQUE "
+                    "REFERENCES messages ON DELETE CASCADE)"))
+                connection.execute(text(
+                    "ALTER TABLE messages DROP COLUMN like_count"))
+                connection.execute(
+                    text("INSERT INTO likes (user_id, message_id) "
+                         "VALUES (:user_id, :message_id)"),
+                    {'user_id': self.user2_id, 'message_id': message_id})
+
+            logged = []
+            migrations.run(db.engine, echo=logged.append)
+            self.assertEqual(logged, ["Restructuring likes",
+                                      "Adding messages.like_count",
+                                      "Creating index ix_likes_message_id"])
+
+            inspector = inspect(db.engine)
+            self.assertEqual(
+                inspector.get_pk_constraint('likes')['constrained_columns'],
+                ['user_id', 'message_id'])
+            self.assertEqual(db.session.get(Message, message_id).like_count, 1)
+
+            like = db.session.get(Likes, (self.user2_id, message_id))
+            self.assertIsNotNone(like.liked_at)
+
+            # a second user can now like the same message
+            db.session.add(Likes(user_id=self.user1_id, message_id=message_id))
+            db.session.commit()
+            self.assertEqual(Likes.query.filter_by(message_id=message_id).count(),
+                             2)
+
+    def test_migrate_counters_and_derived_tables(self):
+        """Databases from before the counters and timelines are filled in"""
+
+        with app.app_context():
+            message = Message(text="Old zebra", user_id=self.user1_id)
+            db.session.add(message)
+            db.session.add(Follows(user_being_followed_id=self.user1_id,
+                                   user_following_id=self.user2_id))
+            db.session.commit()
+            db.session.add(Likes(user_id=self.user2_id, message_id=message.id))
+            db.session.commit()
+            message_id = message.id
+            db.session.close()
+
+            # the schema as it was before counters, timelines and search
+            with db.engine.begin() as connection:
+                connection.execute(text("DROP TABLE timelines, message_terms"))
+                connection.execute(text(
+                    "ALTER TABLE users DROP COLUMN messages_count, "
+                    "DROP COLUMN followers_count, DROP COLUMN following_count, "
+                    "DROP COLUMN likes_count"))
+
+            logged = []
+            migrations.run(db.engine, echo=logged.append)
+            self.assertEqual(logged, [
+                "Adding users.messages_count, followers_count, "
+                "following_count, likes_count",
+                "Creating timelines",
+                "Creating message_terms",
+            ])
+
+            user1 = db.session.get(User, self.user1_id)
+            user2 = db.session.get(User, self.user2_id)
+            self.assertEqual((user1.messages_count, user1.followers_count),
+                             (1, 1))
+            self.assertEqual((user2.following_count, user2.likes_count),
+                             (1, 1))
+            self.assertEqual(
+                {(entry.user_id, entry.message_id)
+                 for entry in TimelineEntry.query},
+                {(self.user1_id, message_id), (self.user2_id, message_id)})
+            self.assertEqual([msg.id for msg in search_messages("zebra")[0]],
+                             [message_id])
+
+            logged.clear()
+            migrations.run(db.engine, echo=logged.append)
+            self.assertEqual(logged, [])
@@ -6,9 +6,17 @@
 
 
 # import os
+import json
+import os
+import tempfile
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows, Likes
+from bs4 import BeautifulSoup
+from sqlalchemy import event, exc, text
+
+import metrics
+import slow_queries
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -24,6 +32,8 @@ from app import app, CURR_USER_KEY
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler-test'
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['TESTING'] = True
+# Cheapest bcrypt cost keeps signup-heavy setUp fast
+app.config['BCRYPT_LOG_ROUNDS'] = 4
 # This is a bit of hack, but don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
@@ -178,4 +188,367 @@ class MessageViewTestCase(TestCase):
                 self.assertEqual(resp.status_code, 200)
                 self.assertIn("Access unauthorized.", str(resp.data))
                 m = Message.query.get(200)
-                self.assertEqual(m, message)
\ No newline at end of file
+                self.assertEqual(m, message)
+
+
+    def setup_follower(self):
+        with app.app_context():
+            user2 = User.signup(username="testuser2",
+                                email="test2@test.com",
+                                password="HASHED_PASSWORD",
+                                image_url=None)
+            db.session.commit()
+            self.user2_id = user2.id
+
+            db.session.add(Follows(user_being_followed_id=self.user1_id,
+                                   user_following_id=self.user2_id))
+            User.repair_counters()
+            db.session.commit()
+
+    def test_add_message_fans_out(self):
+        """Posting a message writes it to the author's and followers' timelines"""
+        self.setup_follower()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post("/messages/new", data={"text": "Fan me out"})
+
+            msg = Message.query.one()
+            owners = {entry.user_id for entry in
+                      TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(owners, {self.user1_id, self.user2_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+
+            resp = c.get("/")
+            self.assertIn("Fan me out", str(resp.data))
+
+    def test_large_author_merged_on_read(self):
+        """Authors over the fan-out limit are merged into the feed on read"""
+        self.setup_follower()
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+
+                c.post("/messages/new", data={"text": "Too popular"})
+
+                msg = Message.query.one()
+                owners = {entry.user_id for entry in
+                          TimelineEntry.query.filter_by(message_id=msg.id)}
+                self.assertEqual(owners, {self.user1_id})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user2_id
+
+                resp = c.get("/")
+                self.assertIn("Too popular", str(resp.data))
+        finally:
+            app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+    def test_fanout_limit_crossing(self):
+        """Messages posted while over the fan-out limit stay in followers'
+        feeds once an unfollow takes the author back down to it"""
+        self.setup_follower()
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        try:
+            with self.client as c:
+                with app.app_context():
+                    user3 = User.signup(username="testuser3",
+                                        email="test3@test.com",
+                                        password="HASHED_PASSWORD",
+                                        image_url=None)
+                    db.session.commit()
+                    user3_id = user3.id
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user3_id
+                c.post(f"/users/follow/{self.user1_id}")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+                c.post("/messages/new", data={"text": "While popular"})
+                msg = Message.query.one()
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user3_id
+                c.post(f"/users/stop-following/{self.user1_id}")
+
+                owners = {entry.user_id for entry in
+                          TimelineEntry.query.filter_by(message_id=msg.id)}
+                self.assertEqual(owners, {self.user1_id, self.user2_id})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user2_id
+                resp = c.get("/")
+                self.assertIn("While popular", str(resp.data))
+        finally:
+            app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+    def test_message_delete_prunes_timelines(self):
+        self.setup_follower()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post("/messages/new", data={"text": "Short lived"})
+            msg = Message.query.one()
+
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+
+    def test_message_counters(self):
+        """Adding and deleting messages keeps messages_count in step"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post("/messages/new", data={"text": "Count me"})
+            self.assertEqual(db.session.get(User, self.user1_id).messages_count, 1)
+
+            msg = Message.query.one()
+            c.post(f"/messages/{msg.id}/delete")
+            db.session.expire_all()
+            self.assertEqual(db.session.get(User, self.user1_id).messages_count, 0)
+
+
+    def test_home_loads_authors_in_batch(self):
+        """Home timeline query count doesn't grow with the number of authors"""
+        with app.app_context():
+            for i in range(5):
+                author = User.signup(username=f"author{i}",
+                                     email=f"author{i}@test.com",
+                                     password="HASHED_PASSWORD",
+                                     image_url=None)
+                db.session.commit()
+                db.session.add(Follows(user_being_followed_id=author.id,
+                                       user_following_id=self.user1_id))
+                db.session.add(Message(text=f"by author {i}", user_id=author.id))
+                db.session.commit()
+
+            User.repair_counters()
+            TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_LIMIT'])
+            db.session.commit()
+            engine = db.engine
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            statements = []
+
+            def count(*args):
+                statements.append(args[2])
+
+            event.listen(engine, 'before_cursor_execute', count)
+            try:
+                resp = c.get("/")
+            finally:
+                event.remove(engine, 'before_cursor_execute', count)
+
+            for i in range(5):
+                self.assertIn(f"by author {i}", str(resp.data))
+            author_loads = [sql for sql in statements
+                            if sql.lstrip().startswith('SELECT users.')
+                            and 'WHERE users.id = ' in sql]
+            self.assertLessEqual(len(author_loads), 1)
+
+
+    def test_message_search(self):
+        """Search ranks messages matching more terms first and tracks deletes"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post("/messages/new", data={"text": "Coffee this morning"})
+            c.post("/messages/new", data={"text": "Morning coffee and a good book"})
+            c.post("/messages/new", data={"text": "Nothing to see here"})
+
+            resp = c.get("/messages/search?q=good+coffee")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            texts = [p.text for p in soup.select('.message-area p')]
+            self.assertEqual(texts, ["Morning coffee and a good book",
+                                     "Coffee this morning"])
+
+            msg = Message.query.filter_by(text="Coffee this morning").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            resp = c.get("/messages/search?q=coffee")
+            self.assertNotIn("Coffee this morning", str(resp.data))
+            self.assertIn("Morning coffee and a good book", str(resp.data))
+
+            resp = c.get("/messages/search?q=coffee&page=0")
+            self.assertEqual(resp.status_code, 400)
+
+            with app.app_context():
+                User.deactivate(self.user1_id)
+                db.session.commit()
+
+            resp = c.get("/messages/search?q=coffee")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("Morning coffee and a good book", str(resp.data))
+
+
+    def test_message_show_conditional_get(self):
+        """Unchanged messages answer 304 to a matching If-None-Match"""
+        with app.app_context():
+            message = Message(text="Cache me", user_id=self.user1_id)
+            db.session.add(message)
+            db.session.commit()
+            message_id = message.id
+
+        with self.client as c:
+            resp = c.get(f"/messages/{message_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+            self.assertIn('Cookie', resp.headers['Vary'])
+            etag = resp.headers['ETag']
+
+            resp = c.get(f"/messages/{message_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # a deploy may change the template, so the cached copy is stale
+            release = app.config['RELEASE_VERSION']
+            app.config['RELEASE_VERSION'] = 'next-release'
+            self.addCleanup(app.config.__setitem__, 'RELEASE_VERSION', release)
+
+            resp = c.get(f"/messages/{message_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+
+            # logging in changes the navbar, so the cached copy is stale
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = c.get(f"/messages/{message_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_static_and_form_cache_headers(self):
+        with self.client as c:
+            resp = c.get("/")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            stylesheet = soup.find('link', rel='stylesheet',
+                                   href=lambda href: 'style.css' in href)
+            self.assertIn("?v=", stylesheet['href'])
+
+            resp = c.get(stylesheet['href'])
+            self.assertEqual(resp.headers['Cache-Control'],
+                             'public, max-age=31536000, immutable')
+
+            resp = c.get("/login")
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+    def test_metrics_count_queries_per_endpoint(self):
+        """/metrics reports each endpoint's latency and query counts"""
+        metrics.request_queries.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.get("/")
+            c.get("/")
+
+            resp = c.get("/metrics")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.content_type.startswith("text/plain"))
+
+            body = resp.get_data(as_text=True)
+            self.assertIn('warbler_request_queries_count{endpoint="homepage"} 2',
+                          body)
+            self.assertIn('warbler_request_duration_seconds_bucket'
+                          '{endpoint="homepage",le="+Inf"}', body)
+            self.assertIn('warbler_template_render_seconds_count'
+                          '{template="home.html"}', body)
+            self.assertIn('warbler_password_hash_queue_depth 0', body)
+
+            total = next(line for line in body.splitlines() if line.startswith(
+                'warbler_request_queries_sum{endpoint="homepage"}'))
+            self.assertGreater(float(total.split()[-1]), 0)
+
+    def test_metrics_forget_failed_statements(self):
+        """A failed statement leaves no timing state on its connection"""
+        with app.app_context():
+            with db.engine.connect() as connection:
+                with self.assertRaises(exc.ProgrammingError):
+                    connection.execute(text("SELECT no_such_column"))
+                self.assertEqual(connection.info['query_start_times'], {})
+
+    def test_slow_query_log_starts_per_process(self):
+        """The log's worker starts on first use, again after a fork"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, "slow.jsonl")
+            with app.app_context():
+                recorder = slow_queries.start(db.engine, threshold_ms=0,
+                                              path=path, explain=False)
+            self.addCleanup(slow_queries.stop)
+            self.assertIsNone(recorder._worker)
+
+            with app.app_context():
+                db.session.execute(text("SELECT 1"))
+                first = recorder._worker
+                self.assertTrue(first.is_alive())
+
+                # as if inherited by a forked worker process
+                recorder._pid = -1
+                db.session.execute(text("SELECT 2"))
+                recorder.flush()
+                self.assertIsNot(recorder._worker, first)
+                self.assertTrue(recorder._worker.is_alive())
+                db.session.rollback()
+
+            with open(path) as log_file:
+                statements = [json.loads(line)['statement']
+                              for line in log_file]
+            self.assertIn("SELECT 2", statements)
+
+    def test_slow_query_log(self):
+        """Slow statements are logged with their route and an EXPLAIN plan"""
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, "slow.jsonl")
+            with app.app_context():
+                slow_queries.start(db.engine, threshold_ms=0, path=path)
+
+            try:
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.user1_id
+                    c.post("/messages/new", data={"text": "Slow hello"})
+                    c.get(f"/users/{self.user1_id}")
+            finally:
+                slow_queries.stop()
+
+            with open(path) as log_file:
+                entries = [json.loads(line) for line in log_file]
+
+            select = next(entry for entry in entries
+                          if entry['endpoint'] == 'users_show'
+                          and entry['statement'].startswith('SELECT'))
+            self.assertEqual(select['path'], f"/users/{self.user1_id}")
+            self.assertIn('Execution Time', select['plan'][0])
+
+            # writes get a plan without being run again
+            insert = next(entry for entry in entries
+                          if entry['statement'].startswith('INSERT INTO messages'))
+            self.assertNotIn('Execution Time', insert['plan'][0])
+            with app.app_context():
+                self.assertEqual(
+                    Message.query.filter_by(text="Slow hello").count(), 1)
+
+            top = slow_queries.summarize(path, top=3)
+            self.assertEqual(len(top), 3)
+            self.assertGreaterEqual(top[0]['total_ms'], top[1]['total_ms'])
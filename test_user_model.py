@@ -5,10 +5,13 @@
 #    python -m unittest test_user_model.py
 
 
-# import os
+import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows, Likes
+import account_purge
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from hashing import HashingPool, HashingPoolBusy
+from threading import Event, Thread
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -24,6 +27,8 @@ from app import app
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler-test'
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['TESTING'] = True
+# Cheapest bcrypt cost keeps signup-heavy setUp fast
+app.config['BCRYPT_LOG_ROUNDS'] = 4
 
 # This is a bit of hack, but don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
@@ -82,7 +87,7 @@ class UserModelTestCase(TestCase):
 
             # User should have no messages & no followers
             self.assertEqual(len(u.messages), 0)
-            self.assertEqual(len(u.followers), 0)
+            self.assertEqual(u.followers.count(), 0)
             
 
     def test_is_followed_by(self):
@@ -162,9 +167,164 @@ class UserModelTestCase(TestCase):
             self.assertFalse(User.authenticate(user1.username, "wrong_password"))
                 
                 
-    # check user password method ####################################
-    def test_check_password(self):
+    def test_repair_counters(self):
+        """repair_counters recomputes counts from follows, likes and messages"""
         with app.app_context():
-            user = User.query.get_or_404(self.user1_id)
-            self.assertTrue(User.check_password(user.username, "HASHED_PASSWORD"))            
-            self.assertFalse(User.check_password(user.username, "wrong_password"))
\ No newline at end of file
+            message = Message(text="Liked message", user_id=self.user1_id)
+            db.session.add(message)
+            db.session.add(Follows(user_being_followed_id=self.user1_id,
+                                   user_following_id=self.user2_id))
+            db.session.commit()
+            db.session.add(Likes(user_id=self.user2_id, message_id=message.id))
+            db.session.commit()
+
+            User.repair_counters()
+            db.session.commit()
+
+            user1 = db.session.get(User, self.user1_id)
+            user2 = db.session.get(User, self.user2_id)
+            self.assertEqual((user1.messages_count, user1.followers_count,
+                              user1.following_count, user1.likes_count),
+                             (1, 1, 0, 0))
+            self.assertEqual((user2.messages_count, user2.followers_count,
+                              user2.following_count, user2.likes_count),
+                             (0, 0, 1, 1))
+
+
+
+    def test_purge_account(self):
+        """A deactivated user is hidden, then purged a batch at a time"""
+        with app.app_context():
+            user3 = User.signup("testuser3", "test3@test.com", "HASHED_PASSWORD", None)
+            db.session.commit()
+            messages = [Message(text=f"Message {n}", user_id=self.user1_id)
+                        for n in range(3)]
+            other = Message(text="Not mine", user_id=self.user2_id)
+            db.session.add_all(messages + [other])
+            db.session.add_all([
+                Follows(user_being_followed_id=self.user1_id,
+                        user_following_id=self.user2_id),
+                Follows(user_being_followed_id=self.user2_id,
+                        user_following_id=self.user1_id),
+                Follows(user_being_followed_id=self.user1_id,
+                        user_following_id=user3.id),
+            ])
+            db.session.commit()
+            db.session.add_all(
+                [Likes(user_id=self.user2_id, message_id=m.id) for m in messages]
+                + [Likes(user_id=self.user1_id, message_id=other.id)])
+            db.session.commit()
+            User.repair_counters()
+            Message.repair_like_counts()
+            TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_LIMIT'])
+            db.session.commit()
+            other_id, user3_id = other.id, user3.id
+
+            User.deactivate(self.user1_id)
+            db.session.commit()
+
+            self.assertFalse(User.authenticate("testuser1", "HASHED_PASSWORD"))
+            self.assertNotIn(self.user1_id,
+                             [u.id for u in User.active().all()])
+
+            account_purge.purge_account(self.user1_id, batch_size=1)
+            db.session.expire_all()
+
+            self.assertIsNone(db.session.get(User, self.user1_id))
+            self.assertEqual(Message.query.filter_by(user_id=self.user1_id).count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(db.session.get(Message, other_id).like_count, 0)
+            self.assertEqual(
+                [(entry.user_id, entry.message_id)
+                 for entry in TimelineEntry.query],
+                [(self.user2_id, other_id)])
+
+            user2 = db.session.get(User, self.user2_id)
+            self.assertEqual((user2.messages_count, user2.followers_count,
+                              user2.following_count, user2.likes_count),
+                             (1, 0, 0, 0))
+            self.assertEqual(db.session.get(User, user3_id).following_count, 0)
+
+
+    def test_purge_skips_active_accounts(self):
+        with app.app_context():
+            self.assertEqual(account_purge.purge_account(self.user1_id), 0)
+            self.assertIsNotNone(db.session.get(User, self.user1_id))
+
+
+    def test_purger_runs_in_each_process(self):
+        """A purger inherited across a fork is replaced, not reused"""
+        with app.app_context():
+            first = account_purge.running(app)
+            self.assertIs(account_purge.running(app), first)
+
+            first.pid = -1
+            second = account_purge.running(app)
+            self.assertIsNot(second, first)
+            self.assertEqual(second.pid, os.getpid())
+            first.close()
+
+
+    def test_delete_user_with_messages(self):
+        """Deleting a user leaves their messages to the database's cascade"""
+        with app.app_context():
+            db.session.add(Message(text="Goes too", user_id=self.user1_id))
+            db.session.commit()
+
+            db.session.delete(db.session.get(User, self.user1_id))
+            db.session.commit()
+
+            self.assertEqual(Message.query.count(), 0)
+
+
+    def test_following_ids_among(self):
+        with app.app_context():
+            user3 = User.signup("testuser3", "test3@test.com", "HASHED_PASSWORD", None)
+            db.session.commit()
+
+            db.session.add(Follows(user_being_followed_id=self.user2_id,
+                                   user_following_id=self.user1_id))
+            db.session.commit()
+
+            user1 = db.session.get(User, self.user1_id)
+            self.assertEqual(
+                user1.following_ids_among([self.user2_id, user3.id]),
+                {self.user2_id})
+            self.assertEqual(user1.following_ids_among([]), set())
+
+
+
+    def test_verify_password(self):
+        with app.app_context():
+            user = db.session.get(User, self.user1_id)
+            self.assertTrue(user.verify_password("HASHED_PASSWORD"))
+            self.assertFalse(user.verify_password("wrong_password"))
+            self.assertFalse(user.verify_password(""))
+
+
+    def test_hashing_pool_busy(self):
+        """A full hashing queue rejects work instead of queueing it"""
+        pool = HashingPool(workers=1, max_pending=1)
+        started, release = Event(), Event()
+
+        def hold_slot():
+            started.set()
+            release.wait()
+
+        holder = Thread(target=pool.run, args=(hold_slot,))
+        holder.start()
+        started.wait()
+
+        try:
+            self.assertEqual(pool.pending, 1)
+            with self.assertRaises(HashingPoolBusy):
+                pool.run(lambda: None, wait=0)
+            self.assertEqual(pool.rejected, 1)
+        finally:
+            release.set()
+            holder.join()
+
+        self.assertEqual(pool.pending, 0)
+        self.assertEqual(pool.run(lambda: "done"), "done")
+        pool.shutdown()
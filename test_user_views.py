@@ -8,7 +8,9 @@
 # import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows, Likes
+from bs4 import BeautifulSoup
+from sqlalchemy import event
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,9 +23,13 @@ from models import db, connect_db, Message, User, Follows, Likes
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import account_purge
+import current_user
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warbler-test'
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['TESTING'] = True
+# Cheapest bcrypt cost keeps signup-heavy setUp fast
+app.config['BCRYPT_LOG_ROUNDS'] = 4
 # This is a bit of hack, but don't use Flask DebugToolbar
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
@@ -93,12 +99,28 @@ class UserViewTestCase(TestCase):
             
             
     def test_users_search(self):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                            record)
+
         with self.client as c:
             resp = c.get("/users?q=test")
 
             self.assertIn("@testuser1", str(resp.data))
             self.assertIn("@testuser2", str(resp.data))
             self.assertNotIn("@user3", str(resp.data)) 
+
+        # results are user cards, not whole users
+        searches = [statement for statement in statements
+                    if 'users.bio' in statement]
+        self.assertTrue(searches)
+        for statement in searches:
+            self.assertNotIn('users.password', statement)
             
 
     def test_user_show(self):
@@ -122,6 +144,31 @@ class UserViewTestCase(TestCase):
             db.session.commit()
         
         
+    def test_user_show_checks_follow_once(self):
+        """The profile's ETag and its follow button share one lookup"""
+        self.setup_followers()
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                            record)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            resp = c.get(f"/users/{self.user2_id}")
+            self.assertIn("Unfollow", str(resp.data))
+
+        lookups = [statement for statement in statements
+                   if 'FROM follows' in statement
+                   and 'follows.user_being_followed_id =' in statement]
+        self.assertEqual(len(lookups), 1)
+
+
     def test_show_following(self):
         """Test that this Show list of people this user is following.
         """
@@ -153,6 +200,54 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("@user4", str(resp.data))
             
             
+    def test_following_and_directory_pages(self):
+        """Follow lists and the directory page by id, loading card columns"""
+        self.setup_followers()
+        page_size = app.config['USER_LIST_PAGE_SIZE']
+        app.config['USER_LIST_PAGE_SIZE'] = 1
+        self.addCleanup(app.config.__setitem__, 'USER_LIST_PAGE_SIZE', page_size)
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                            record)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            resp = c.get(f"/users/{self.user3_id}/following")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            self.assertEqual([p.text for p in soup.select('.card-link p')],
+                             ["@testuser1"])
+            more = soup.find('a', string="Load more")['href']
+            self.assertEqual(
+                more, f"/users/{self.user3_id}/following?after={self.user1_id}")
+
+            soup = BeautifulSoup(c.get(more).data, 'html.parser')
+            self.assertEqual([p.text for p in soup.select('.card-link p')],
+                             ["@testuser2"])
+            self.assertIsNone(soup.find('a', string="Load more"))
+
+            resp = c.get(f"/users?after={self.user3_id}")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            self.assertEqual([p.text for p in soup.select('.card-link p')],
+                             ["@user4"])
+
+            resp = c.get("/users?after=nope")
+            self.assertEqual(resp.status_code, 400)
+
+        listings = [statement for statement in statements
+                    if 'users.bio' in statement and 'LIMIT' in statement]
+        self.assertTrue(listings)
+        for statement in listings:
+            self.assertNotIn('users.password', statement)
+            self.assertNotIn('users.location', statement)
+
     def test_unauthorized_following_page_access(self):
         self.setup_followers()
         with self.client as c:
@@ -179,13 +274,54 @@ class UserViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.user3_id
 
-            resp = c.post(f"/users/follow/{self.user1_id}", follow_redirects=True)
+            # the redirect lands on a streamed page; buffer it so the
+            # test client doesn't pop its context mid-stream
+            resp = c.post(f"/users/follow/{self.user1_id}", follow_redirects=True,
+                          buffered=True)
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser1", str(resp.data))
             self.assertNotIn("@testuser2", str(resp.data))
             self.assertNotIn("@user4", str(resp.data))    
             
             
+    def test_follow_self(self):
+        """Users can't follow themselves, and old self-follows do no harm"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            resp = c.post(f"/users/follow/{self.user3_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertFalse(User.follows(self.user3_id, self.user3_id))
+
+            soup = BeautifulSoup(c.get("/users").data, 'html.parser')
+            self.assertIsNone(
+                soup.find('form', action=f"/users/follow/{self.user3_id}"))
+            self.assertIsNotNone(
+                soup.find('form', action=f"/users/follow/{self.user1_id}"))
+
+            # rows written before self-follows were refused
+            with app.app_context():
+                db.session.add(Follows(user_being_followed_id=self.user3_id,
+                                       user_following_id=self.user3_id))
+                db.session.commit()
+
+            resp = c.post("/messages/new", data={"text": "Just once"})
+            self.assertEqual(resp.status_code, 302)
+
+            with app.app_context():
+                TimelineEntry.rebuild(app.config['TIMELINE_FANOUT_LIMIT'])
+                db.session.commit()
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(user_id=self.user3_id).count(),
+                    1)
+
+            c.post(f"/users/stop-following/{self.user3_id}")
+            with app.app_context():
+                self.assertEqual(
+                    TimelineEntry.query.filter_by(user_id=self.user3_id).count(),
+                    1)
+
     def test_stop_following(self):
         """Test that user2 is removed from user3 following list while user2 remains in list.
         """
@@ -194,7 +330,10 @@ class UserViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.user3_id
 
-            resp = c.post(f"/users/stop-following/{self.user2_id}", follow_redirects=True)
+            # the redirect lands on a streamed page; buffer it so the
+            # test client doesn't pop its context mid-stream
+            resp = c.post(f"/users/stop-following/{self.user2_id}", follow_redirects=True,
+                          buffered=True)
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser1", str(resp.data))
             self.assertNotIn("@testuser2", str(resp.data))
@@ -230,6 +369,40 @@ class UserViewTestCase(TestCase):
                 self.assertEqual(likes[0].user_id, self.user3_id)
 
 
+    def test_many_users_like_one_message(self):
+        """Several users can like a message; like_count follows along"""
+        with app.app_context():
+            message = Message(text="Crowd pleaser", user_id=self.user1_id)
+            db.session.add(message)
+            db.session.flush()
+            TimelineEntry.fan_out(message, app.config['TIMELINE_FANOUT_LIMIT'])
+            db.session.commit()
+            message_id = message.id
+
+        for user_id in (self.user2_id, self.user3_id, self.user4_id):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post(f"/users/add_like/{message_id}")
+
+        with self.client as c:
+            # user4 toggles their like back off
+            c.post(f"/users/add_like/{message_id}")
+
+            # the author sees the count on their own home timeline
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            resp = c.get("/")
+            self.assertIn(f'data-like-count="{message_id}">2<',
+                          resp.get_data(as_text=True))
+
+        with app.app_context():
+            self.assertEqual(db.session.get(Message, message_id).like_count, 2)
+            self.assertEqual(db.session.get(User, self.user3_id).likes_count, 1)
+            self.assertEqual(
+                Likes.query.filter_by(message_id=message_id).count(), 2)
+
+
     def test_register_user_unlike(self):
         """Test if currently liked message by users 3 gets unliked
         """
@@ -279,4 +452,293 @@ class UserViewTestCase(TestCase):
             resp = c.get(f"/users/{self.user3_id}/likes", follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
 
-            self.assertIn("Access unauthorized", str(resp.data))
\ No newline at end of file
+            self.assertIn("Access unauthorized", str(resp.data))
+
+
+    def test_follow_backfills_timeline(self):
+        """Following a user copies their recent messages into the home feed"""
+        with app.app_context():
+            db.session.add(Message(text="Posted before the follow",
+                                   user_id=self.user1_id))
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+            resp = c.get("/")
+            self.assertIn("Posted before the follow", str(resp.data))
+
+            c.post(f"/users/stop-following/{self.user1_id}")
+            resp = c.get("/")
+            self.assertNotIn("Posted before the follow", str(resp.data))
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.user3_id).count(), 0)
+
+
+
+    def test_user_show_pagination(self):
+        """Profile messages page with ?before= / ?after= cursors"""
+        with app.app_context():
+            for i in range(5):
+                db.session.add(Message(text=f"warble number {i}",
+                                       user_id=self.user1_id))
+                db.session.commit()
+
+        app.config['TIMELINE_PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.user1_id}")
+                html = str(resp.data)
+                self.assertIn("warble number 4", html)
+                self.assertIn("warble number 3", html)
+                self.assertNotIn("warble number 2", html)
+
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                older = soup.find('a', string='Load more')['href']
+                resp = c.get(older)
+                html = str(resp.data)
+                self.assertIn("warble number 2", html)
+                self.assertIn("warble number 1", html)
+                self.assertNotIn("warble number 3", html)
+
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                newer = soup.find('a', string='Newer')['href']
+                resp = c.get(newer)
+                self.assertIn("warble number 3", str(resp.data))
+                self.assertNotIn("warble number 2", str(resp.data))
+
+                resp = c.get(f"/users/{self.user1_id}?before=garbage")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['TIMELINE_PAGE_SIZE'] = 100
+
+
+
+    def test_follow_and_like_counters(self):
+        """Follow, unfollow, like and unlike keep the user counters in step"""
+        with app.app_context():
+            message = Message(text="Count this like", user_id=self.user1_id)
+            db.session.add(message)
+            db.session.commit()
+            message_id = message.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+            c.post(f"/users/add_like/{message_id}")
+
+            user1 = db.session.get(User, self.user1_id)
+            user3 = db.session.get(User, self.user3_id)
+            self.assertEqual(user1.followers_count, 1)
+            self.assertEqual(user3.following_count, 1)
+            self.assertEqual(user3.likes_count, 1)
+
+            resp = c.get(f"/users/{self.user3_id}")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            stats = [int(a.text) for a in soup.select('.stat h4 a')]
+            self.assertEqual(stats, [0, 1, 0, 1])
+
+            c.post(f"/users/stop-following/{self.user1_id}")
+            c.post(f"/users/add_like/{message_id}")
+
+            db.session.expire_all()
+            self.assertEqual(db.session.get(User, self.user1_id).followers_count, 0)
+            user3 = db.session.get(User, self.user3_id)
+            self.assertEqual(user3.following_count, 0)
+            self.assertEqual(user3.likes_count, 0)
+
+    def test_follow_writes_single_rows(self):
+        """Repeat follows are no-ops and never load follow collections"""
+        self.setup_followers()
+        with app.app_context():
+            User.repair_counters()
+            db.session.commit()
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                            record)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+            c.post(f"/users/follow/{self.user4_id}")
+            c.post(f"/users/stop-following/{self.user4_id}")
+            c.post(f"/users/stop-following/{self.user4_id}")
+
+            resp = c.post("/users/follow/0")
+            self.assertEqual(resp.status_code, 404)
+
+            db.session.expire_all()
+            self.assertEqual(
+                db.session.get(User, self.user1_id).followers_count, 1)
+            self.assertEqual(
+                db.session.get(User, self.user4_id).followers_count, 0)
+            user3 = db.session.get(User, self.user3_id)
+            self.assertEqual(user3.following_count, 2)
+
+        follow_reads = [statement for statement in statements
+                        if statement.startswith('SELECT')
+                        and 'FROM users, follows' in statement]
+        self.assertEqual(follow_reads, [])
+
+
+
+    def test_list_users_follow_buttons(self):
+        """User directory shows Unfollow only for users already followed"""
+        self.setup_followers()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            resp = c.get("/users")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            unfollow = {form['action'] for form in soup.find_all('form')
+                        if 'stop-following' in form.get('action', '')}
+            self.assertEqual(unfollow, {
+                f"/users/stop-following/{self.user1_id}",
+                f"/users/stop-following/{self.user2_id}",
+            })
+
+    def test_list_users_streams_in_batches(self):
+        """The directory streams every user, with follow state per batch"""
+        self.setup_followers()
+        batch_size = app.config['STREAM_BATCH_SIZE']
+        app.config['STREAM_BATCH_SIZE'] = 1
+        self.addCleanup(app.config.__setitem__, 'STREAM_BATCH_SIZE', batch_size)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            resp = c.get("/users")
+            self.assertTrue(resp.is_streamed)
+
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            cards = [(card.select_one('.card-link p').text,
+                      card.find('button') and card.find('button').text)
+                     for card in soup.select('.user-card')]
+            self.assertEqual(cards, [
+                ("@testuser1", "Unfollow"),
+                ("@testuser2", "Unfollow"),
+                ("@user3", None),
+                ("@user4", "Follow"),
+            ])
+
+
+
+    def test_users_search_ranking(self):
+        """Exact and prefix username matches rank ahead of bio matches"""
+        with app.app_context():
+            user4 = db.session.get(User, self.user4_id)
+            user4.bio = "Biggest fan of user3"
+            db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=user3")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            names = [p.text for p in soup.select('.card-link p')]
+            self.assertEqual(names, ["@user3", "@user4"])
+
+            resp = c.get("/users?q=100%25")
+            self.assertIn("Sorry, no users found", str(resp.data))
+
+
+
+    def test_current_user_snapshot_cached(self):
+        """g.user comes from the snapshot cache until a write invalidates it"""
+        with app.app_context():
+            engine = db.engine
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            c.get("/messages/new")
+
+            statements = []
+
+            def count(*args):
+                statements.append(args[2])
+
+            event.listen(engine, 'before_cursor_execute', count)
+            try:
+                resp = c.get("/messages/new")
+            finally:
+                event.remove(engine, 'before_cursor_execute', count)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(statements, [])
+
+            c.post(f"/users/follow/{self.user1_id}")
+            self.assertIsNone(current_user.snapshots.get(self.user3_id))
+
+            resp = c.get("/")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            following = soup.find('a', href=f"/users/{self.user3_id}/following")
+            self.assertEqual(following.text, "1")
+
+
+
+    def test_delete_user(self):
+        """Deleting an account hides it at once and purges it in the background"""
+        with app.app_context():
+            message = Message(text="Soon gone", user_id=self.user1_id)
+            db.session.add(message)
+            db.session.add(Follows(user_being_followed_id=self.user1_id,
+                                   user_following_id=self.user3_id))
+            db.session.commit()
+            db.session.add(Likes(user_id=self.user3_id, message_id=message.id))
+            db.session.commit()
+            User.repair_counters()
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "/signup")
+
+            self.assertEqual(c.get(f"/users/{self.user1_id}").status_code, 404)
+            resp = c.get("/users")
+            self.assertNotIn("testuser1", resp.text)
+            resp = c.post("/login", data={"username": "testuser1",
+                                          "password": "HASHED_PASSWORD"})
+            self.assertIn("Invalid credentials.", resp.text)
+
+        account_purge.purger.flush()
+
+        with app.app_context():
+            self.assertIsNone(db.session.get(User, self.user1_id))
+            self.assertEqual(Message.query.count(), 0)
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+            user3 = db.session.get(User, self.user3_id)
+            self.assertEqual((user3.following_count, user3.likes_count), (0, 0))
+
+    def test_profile_checks_current_users_password(self):
+        """Renaming yourself verifies your own password, not the new name's"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user3_id
+
+            resp = c.post("/users/profile", data={
+                "username": "renamed3",
+                "email": "user3@user.com",
+                "password": "HASHED_PASSWORD",
+            })
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(db.session.get(User, self.user3_id).username,
+                             "renamed3")